@@ -0,0 +1,275 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+import aiohttp
+
+import feeds
+import filters
+from log import logger
+from main import (ingest, log_startup, poll_done, poll_failed,
+                  release_held)
+import matrix
+import metrics
+import reddit
+import routing
+import scheduler
+import storage
+
+
+INGEST_QUEUE_SIZE = 10
+SEND_CONCURRENCY = 1
+
+
+class AsyncRuntime:
+    def __init__(self, config):
+        self.config = config
+        program_cfg = config["programconfig"]
+        matrix_cfg = config["matrixconfig"]
+        self.feeds = feeds.from_config(config)
+        self.user_agent = program_cfg["user_agent"]
+        self.default_roomid = matrix_cfg["roomid"]
+        self.concurrency = matrix_cfg.getint("send_concurrency",
+                                             fallback=SEND_CONCURRENCY)
+        self.servers = matrix.homeservers_from_config(config)
+        self.router = routing.from_config(config, self.feeds)
+        # bounded, so polling waits when ingest falls behind
+        self.ingest_queue = asyncio.Queue(INGEST_QUEUE_SIZE)
+        # one for the dispatcher and one per destination
+        self.wakeup = asyncio.Event()
+        self.deliver_wakeups = {}
+        self.send_tasks = set()
+        # all sqlite work runs in this single thread, as sqlite connections
+        # must be used from the thread that opened them
+        self.db_executor = ThreadPoolExecutor(1, "db")
+
+    def in_db(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self.db_executor, fn, *args)
+
+    async def wait(self, event, seconds):
+        try:
+            await asyncio.wait_for(event.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+        event.clear()
+
+    def notify(self):
+        self.wakeup.set()
+        for event in self.deliver_wakeups.values():
+            event.set()
+
+    async def fetch_page(self, feed):
+        url, validators = await self.in_db(self.poll_url, feed)
+        headers = reddit.conditional_headers(*validators)
+        if self.user_agent:
+            headers["User-Agent"] = self.user_agent
+        try:
+            async with self.http.get(url, headers=headers) as resp:
+                if resp.status == 304:
+                    logger.debug("{}: not modified".format(feed.name))
+                    return None
+                if resp.status != 200:
+                    raise reddit.fetch_error(url, resp.status,
+                                             resp.headers.get("Retry-After"))
+                return reddit.Page(url, await resp.read(),
+                                   resp.headers.get("ETag"),
+                                   resp.headers.get("Last-Modified"))
+        except aiohttp.ClientError as e:
+            raise reddit.FetchError("{}: request failed: {}".format(
+                                        feed.name, e))
+
+    def poll_url(self, feed):
+        url = reddit.poll_url(self.db, feed)
+        return url, self.db.http_validators(feed.name, url)
+
+    async def poll_loop(self, feed, schedule):
+        while True:
+            await asyncio.sleep(schedule.delay())
+            try:
+                new_count = await self.poll(feed)
+            except reddit.FetchError as e:
+                poll_failed(feed, schedule, e)
+            except Exception as e:
+                logger.exception(e)
+                poll_failed(feed, schedule, e)
+            else:
+                poll_done(feed, schedule, new_count)
+
+    async def poll(self, feed):
+        new_count = 0
+        max_pages = max(1, feed.max_catchup_pages)
+        for n in range(1, max_pages + 1):
+            with metrics.STAGE_SECONDS.time(feed=feed.name, stage="fetch"):
+                page = await self.fetch_page(feed)
+            # wait for the page to be stored, its result drives the schedule
+            # and the next poll URL. Without a page the mod actions held by
+            # earlier checks are queued.
+            done = asyncio.get_running_loop().create_future()
+            await self.ingest_queue.put((feed, page, n == max_pages, done))
+            count, more = await done
+            new_count += count
+            if not more:
+                break
+        return new_count
+
+    def ingest_page(self, feed, page, last_page):
+        if not page:
+            release_held(self.db, feed, self.router)
+            return 0, False
+        mod_actions, more = ingest(self.db, feed, self.router, page,
+                                   last_page)
+        return len(mod_actions), more
+
+    async def ingest_loop(self):
+        while True:
+            feed, page, last_page, done = await self.ingest_queue.get()
+            try:
+                count, more = await self.in_db(self.ingest_page, feed, page,
+                                               last_page)
+                if not more:
+                    # the messages of all pages are queued now
+                    self.notify()
+                done.set_result((count, more))
+            except Exception as e:
+                done.set_exception(e)
+
+    async def dispatch_loop(self):
+        # one deliver_loop per destination with pending messages, so a slow
+        # room or homeserver does not hold up the others. Also prunes the
+        # outbox like the sync Sender.
+        pruned = 0
+        while True:
+            try:
+                destinations = await self.in_db(self.outbox.destinations)
+            except Exception as e:
+                logger.exception(e)
+                destinations = []
+            now = time.time()
+            if now - pruned > matrix.OUTBOX_PRUNE_INTERVAL_SECONDS:
+                pruned = now
+                try:
+                    await self.in_db(self.outbox.prune,
+                                     now - matrix.OUTBOX_KEEP_SECONDS)
+                except Exception as e:
+                    logger.exception(e)
+            for server, room in destinations:
+                if (server, room) in self.deliver_wakeups:
+                    continue
+                if server not in self.servers:
+                    logger.error("messages queued for unknown homeserver {},"
+                                 " add a [server:{}] section to send"
+                                 " them".format(server, server))
+                    continue
+                self.deliver_wakeups[server, room] = asyncio.Event()
+                task = asyncio.create_task(
+                    self.deliver_loop(self.servers[server], room))
+                self.send_tasks.add(task)
+                task.add_done_callback(self.send_tasks.discard)
+            await self.wait(self.wakeup, matrix.IDLE_WAIT_SECONDS)
+
+    async def deliver_loop(self, server, room):
+        wakeup = self.deliver_wakeups[server.name, room]
+        slots = asyncio.Semaphore(self.concurrency)
+        in_flight = set()
+        while True:
+            await slots.acquire()
+            try:
+                msg = await self.in_db(self.outbox.next_message, server.name,
+                                       room, tuple(in_flight))
+            except Exception as e:
+                logger.exception(e)
+                msg = None
+            if msg is None:
+                slots.release()
+                await self.wait(wakeup, matrix.IDLE_WAIT_SECONDS)
+                continue
+            delay = msg.next_attempt - time.time()
+            if delay > 0:
+                slots.release()
+                await self.wait(wakeup, delay)
+                continue
+            in_flight.add(msg.seq)
+            task = asyncio.create_task(
+                self.send(server, msg, slots, in_flight))
+            self.send_tasks.add(task)
+            task.add_done_callback(self.send_tasks.discard)
+
+    async def send(self, server, msg, slots, in_flight):
+        try:
+            status = await self.send_message(server, msg)
+            await self.in_db(matrix.record_result, self.outbox, msg, status)
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            in_flight.discard(msg.seq)
+            slots.release()
+
+    async def send_message(self, server, msg):
+        with metrics.SEND_SECONDS.time(server=metrics.server_label(
+                                           server.name)):
+            return await self.put_message(server, msg)
+
+    async def put_message(self, server, msg):
+        roomid = msg.room or self.default_roomid
+        url = matrix.room_send_url(server.url, roomid) + matrix.txid(roomid,
+                                                                     msg.key)
+        data = matrix.message(msg.body, msg.formatted_body)
+        headers = {"Authorization": "Bearer " + server.token}
+        if self.user_agent:
+            headers["User-Agent"] = self.user_agent
+        logger.info("sending: " + msg.body)
+        while True:
+            wait_sec = server.bucket.reserve()
+            if wait_sec:
+                await asyncio.sleep(wait_sec)
+                continue
+            try:
+                async with self.http.put(url, data=data,
+                                         headers=headers) as r:
+                    body = await r.text()
+                    status = r.status
+                    retry_after = matrix.retry_after_seconds(
+                        body, r.headers, matrix.SEND_RETRY_SECONDS)
+            except aiohttp.ClientError as e:
+                logger.warning("matrix: request failed: " + str(e))
+                return None
+            if status == 429:
+                # rate limiting is not an error, wait as long as asked to
+                server.bucket.throttled(retry_after)
+                matrix.rate_limited(server, retry_after)
+                continue
+            if status != 200:
+                logger.warning("matrix: response status {}".format(status))
+            else:
+                server.bucket.succeeded()
+            return status
+
+    async def run(self):
+        self.db = await self.in_db(storage.from_config, self.config,
+                                   self.feeds)
+        self.outbox = await self.in_db(storage.outbox_from_config,
+                                       self.config)
+        try:
+            # one session, and so one connection pool, for Reddit and Matrix
+            async with aiohttp.ClientSession(
+                    auto_decompress=True,
+                    headers={"Accept-Encoding": "gzip, deflate"}) as self.http:
+                schedules = scheduler.from_config(self.config, self.feeds)
+                await asyncio.gather(
+                    self.ingest_loop(), self.dispatch_loop(),
+                    *(self.poll_loop(feed, schedule)
+                      for schedule, feed in zip(schedules, self.feeds)))
+        finally:
+            await self.in_db(self.outbox.close)
+            await self.in_db(self.db.close)
+            self.db_executor.shutdown()
+            filters.log_hits(logger)
+
+
+def run(config):
+    runtime = AsyncRuntime(config)
+    logger.info("starting async runtime")
+    log_startup(config, runtime.feeds)
+    metrics.from_config(config)
+    asyncio.run(runtime.run())
@@ -0,0 +1,93 @@
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+from log import logger
+import metrics
+import reddit
+from utils import chunks
+
+
+BACKFILL_PAGE_LIMIT = 100 # the largest page Reddit serves
+MAX_FETCH_ATTEMPTS = 5
+RETRY_SECONDS = 10
+
+
+# Walks a feed's listing from the newest page to the oldest by following the
+# "after" cursors. Mod actions are stored but not posted. The cursor is saved
+# in the same transaction as each page, so an interrupted backfill resumes
+# where it stopped. Cursors are sequential, so the only overlap is fetching
+# the next page while the current one is stored: pages are parsed as a
+# stream and the next fetch starts as soon as the cursor has been parsed.
+
+
+def page_url(feed, after):
+    url = reddit.replace_query_param(feed.url, "limit", BACKFILL_PAGE_LIMIT)
+    return reddit.replace_query_param(url, "after", after) if after else url
+
+
+def fetch_content(url, user_agent):
+    for attempt in range(1, MAX_FETCH_ATTEMPTS + 1):
+        try:
+            return reddit.fetch_resp(url, user_agent=user_agent).content
+        except reddit.FetchError as e:
+            if attempt == MAX_FETCH_ATTEMPTS:
+                raise
+            wait_sec = e.retry_after or RETRY_SECONDS * 2 ** (attempt - 1)
+            logger.warning("{}, retrying in {} s".format(e, wait_sec))
+            metrics.RETRY_WAIT_SECONDS.inc(wait_sec, service="reddit")
+            time.sleep(wait_sec)
+
+
+def store_chunk(storage, feed, chunk, newest_chunk):
+    mod_actions = feed.store_filter.filter(chunk)
+    storage.insert_mod_actions(feed.name, mod_actions, ignore_existing=True)
+    if newest_chunk:
+        # whatever is newer than this was already seen, polling must not
+        # post it again
+        storage.update_newest_mod_action(feed.name, chunk)
+    storage.save_raw(chunk)
+    return len(mod_actions)
+
+
+def backfill(storage, feed, max_pages=None):
+    if feed.mode != "json":
+        raise Exception("{}: only json feeds can be backfilled".format(
+                            feed.name))
+    after = storage.backfill_cursor(feed.name)
+    newest_chunk = after is None
+    if not newest_chunk:
+        logger.info("{}: resuming backfill after {}".format(feed.name, after))
+    pages = saved = 0
+    with ThreadPoolExecutor(1, "backfill") as executor:
+        pending = executor.submit(fetch_content, page_url(feed, after),
+                                  feed.user_agent)
+        while pending:
+            listing = reddit.listing_from_json(pending.result(),
+                                               storage.saves_raw)
+            pending = None
+            pages += 1
+            last_page = max_pages and pages >= max_pages
+
+            def prefetch():
+                if not (pending or last_page) and listing.after:
+                    return executor.submit(fetch_content,
+                                           page_url(feed, listing.after),
+                                           feed.user_agent)
+                return pending
+
+            with storage.transaction():
+                for chunk in chunks(listing.mod_actions,
+                                    reddit.INGEST_CHUNK_SIZE):
+                    saved += store_chunk(storage, feed, chunk, newest_chunk)
+                    newest_chunk = False
+                    pending = prefetch()
+                storage.set_backfill_cursor(feed.name, listing.after)
+            pending = prefetch()
+            logger.info("{}: backfilled page {}, {} mod actions".format(
+                            feed.name, pages, saved))
+    if listing.after:
+        logger.info("{}: backfill stopped after {} pages, run again to"
+                    " continue".format(feed.name, pages))
+    else:
+        logger.info("{}: backfill complete".format(feed.name))
+    return saved
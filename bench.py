@@ -0,0 +1,145 @@
+import argparse
+import json
+import time
+import tracemalloc
+
+import reddit
+
+
+# Parse time and memory per mod action for the JSON and Atom parsers, on
+# synthetic pages shaped like Reddit's mod log or on recorded ones given with
+# --json and --atom. Run: python3 bench.py
+
+
+ACTIONS = ["removelink", "removecomment", "approvelink", "banuser",
+           "spamcomment", "approvecomment"]
+ATOM_ACTIONS = ["removed link", "removed comment", "approved link",
+                "banned user", "spam comment", "approved comment"]
+TS0 = 1600000000
+
+
+def json_object(i):
+    action = ACTIONS[i % len(ACTIONS)]
+    return {"kind": "modaction", "data": {
+        "id": "ModAction_{:08x}".format(i),
+        "created_utc": float(TS0 + i),
+        "mod": "mod{}".format(i % 5),
+        "subreddit": "decred",
+        "action": action,
+        "target_title": "title of post {}".format(i),
+        "target_author": "user{}".format(i),
+        "target_permalink": "/r/decred/comments/p{}/slug/".format(i)
+            if action.endswith("link")
+            else "/r/decred/comments/p{}/slug/c{}/".format(i, i),
+        "details": "remove",
+        "description": None,
+    }}
+
+
+def json_page(children, after=None):
+    return json.dumps({"kind": "Listing", "data": {
+        "children": children, "after": after, "before": None}}).encode()
+
+
+def json_listing(n):
+    return json_page([json_object(i) for i in reversed(range(n))])
+
+
+def atom_entry(i):
+    return ("<entry><author><name>/u/mod{mod}</name>"
+            "<uri>https://www.reddit.com/user/mod{mod}</uri></author>"
+            '<category term="decred" label="r/decred"/>'
+            '<content type="html">&lt;p&gt;{action} by user{i}&lt;/p&gt;'
+            "</content>"
+            "<id>https://www.reddit.com/r/decred/about/log/"
+            "ModAction_{id:08x}</id>"
+            '<link href="https://www.reddit.com/r/decred/comments/p{i}/"/>'
+            "<updated>{updated}</updated>"
+            "<title>decred: mod{mod} {action} by user{i} &amp; co</title>"
+            "</entry>".format(
+                id=i, i=i, mod=i % 5, action=ATOM_ACTIONS[i % 6],
+                updated=time.strftime("%Y-%m-%dT%H:%M:%S+00:00",
+                                      time.gmtime(TS0 + i))))
+
+
+def atom_page(entries):
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<feed xmlns="http://www.w3.org/2005/Atom">'
+            "<title>mod log</title>" + "".join(entries) + "</feed>").encode()
+
+
+def atom_feed(n):
+    return atom_page([atom_entry(i) for i in reversed(range(n))])
+
+
+def parse_time(parse, content, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        parse(content)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def retained_bytes(parse, content):
+    # memory still allocated while the parsed mod actions are alive, and the
+    # peak during parsing
+    tracemalloc.start()
+    mod_actions = parse(content)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del mod_actions
+    return retained, peak
+
+
+def report(name, parse, content, n, repeat):
+    elapsed = parse_time(parse, content, repeat)
+    retained, peak = retained_bytes(parse, content)
+    print("{:<18} {:>10.1f} {:>12.0f} {:>12.0f}".format(
+        name, elapsed / n * 1e6, retained / n, peak / n))
+
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def check_atom_parity(content):
+    fast = list(reddit.mod_actions_from_atom(content))
+    slow = list(reddit.mod_actions_from_feedparser(content))
+    if list(map(repr, fast)) != list(map(repr, slow)):
+        raise Exception("Atom parsers disagree")
+    return len(fast)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=5000,
+                        help="mod actions per synthetic page")
+    parser.add_argument("--json", help="recorded JSON listing file")
+    parser.add_argument("--atom", help="recorded Atom feed file")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    json_content = read_file(args.json) if args.json else json_listing(args.n)
+    atom_content = read_file(args.atom) if args.atom else atom_feed(args.n)
+    json_n = len(reddit.mod_actions_from_json(json_content))
+    atom_n = check_atom_parity(atom_content)
+    print("{} JSON and {} Atom mod actions, JSON parser: {}".format(
+        json_n, atom_n, "ijson" if reddit.ijson else "json"))
+    print("{:<18} {:>10} {:>12} {:>12}".format(
+        "", "us/action", "bytes/action", "peak/action"))
+    report("json", lambda c: reddit.mod_actions_from_json(c, False),
+           json_content, json_n, args.repeat)
+    report("json, raw kept", reddit.mod_actions_from_json,
+           json_content, json_n, args.repeat)
+    report("atom", lambda c: list(reddit.mod_actions_from_atom(c)),
+           atom_content, atom_n, args.repeat)
+    report("atom, feedparser",
+           lambda c: list(reddit.mod_actions_from_feedparser(c)),
+           atom_content, atom_n, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Compression of raw mod action JSON. Every object is compressed on its own,
+# so single rows stay quick to read, with a shared dictionary that holds the
+# keys and values repeated across rows: field names, subreddit and mod names,
+# action strings. zstd is used when the zstandard package is installed,
+# zlib with a preset dictionary otherwise.
+
+
+CODEC_ZLIB = "zlib"
+CODEC_ZSTD = "zstd"
+# deflate can not look further back than 32 KiB, so a larger dictionary
+# would be wasted on zlib
+DICT_SIZE = 32 * 1024
+ZLIB_LEVEL = 9
+ZSTD_LEVEL = 12
+
+# Used until enough rows exist to train a dictionary on: the keys of Reddit
+# mod action objects and frequent action values
+SEED_DICT = (
+    b'{"action":"approvecomment","created_utc":"description":null,'
+    b'"details":"remove","id":"ModAction_","mod":"AutoModerator",'
+    b'"mod_id36":"sr_id36":"subreddit":"subreddit_name_prefixed":"r/",'
+    b'"target_author":"target_body":"target_fullname":"t1_",'
+    b'"target_permalink":"/r/","/comments/","target_title":null,"type":'
+    b'"removecomment","removelink","spamlink","spamcomment","approvelink",'
+    b'"banuser","unbanuser","distinguish","sticky","editflair","wikirevise",'
+    b'"created_utc":1')
+
+
+def default_codec():
+    return CODEC_ZSTD if zstandard else CODEC_ZLIB
+
+
+def train_dictionary(codec, samples):
+    # samples are raw JSON bytes, the most recent last
+    if codec == CODEC_ZSTD:
+        try:
+            return zstandard.train_dictionary(DICT_SIZE, samples).as_bytes()
+        except zstandard.ZstdError:
+            pass # too few samples, use their content as is
+    # for zlib the most useful content goes to the end of the dictionary,
+    # where matches are the nearest
+    return b"".join(samples)[-DICT_SIZE:] or SEED_DICT
+
+
+class Codec:
+    def __init__(self, codec, dictionary):
+        self.codec = codec
+        if codec == CODEC_ZLIB:
+            # raw deflate streams, without the zlib header and checksum
+            self.compressor = zlib.compressobj(ZLIB_LEVEL, zlib.DEFLATED,
+                                               -15, zdict=dictionary)
+            self.decompressor = zlib.decompressobj(-15, zdict=dictionary)
+        elif codec == CODEC_ZSTD:
+            if not zstandard:
+                raise Exception("the zstandard package is needed to read"
+                                " zstd compressed raw data")
+            zdict = zstandard.ZstdCompressionDict(dictionary)
+            self.compressor = zstandard.ZstdCompressor(
+                level=ZSTD_LEVEL, dict_data=zdict, write_checksum=False,
+                write_dict_id=False)
+            self.decompressor = zstandard.ZstdDecompressor(dict_data=zdict)
+        else:
+            raise Exception("unexpected codec: " + codec)
+
+    def compress(self, data):
+        if self.codec == CODEC_ZLIB:
+            # copying the primed state is cheaper than loading the
+            # dictionary again
+            c = self.compressor.copy()
+            return c.compress(data) + c.flush()
+        return self.compressor.compress(data)
+
+    def decompress(self, blob):
+        if self.codec == CODEC_ZLIB:
+            d = self.decompressor.copy()
+            return d.decompress(blob) + d.flush()
+        return self.decompressor.decompress(blob)
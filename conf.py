@@ -1,7 +1,13 @@
 import configparser
 
-config = configparser.ConfigParser()
-config.read("config.ini")
+CONFIG_FILE = "config.ini"
+
+
+# The config is read once by main.py and passed to the code that needs it.
+def load(path=CONFIG_FILE):
+    config = configparser.ConfigParser()
+    config.read(path)
+    return config
 
 def enabled(value):
     return value.lower() == "true"
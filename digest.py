@@ -0,0 +1,87 @@
+import hashlib
+
+import render
+
+
+DIGEST_THRESHOLD = 0 # 0 disables digests
+DIGEST_WINDOW_SECONDS = 600
+DIGEST_MAX_ITEMS = 50
+
+
+def group_key(ma):
+    return (ma.modname, ma.action, ma.place)
+
+
+def group_mod_actions(mod_actions, window_secs, max_items):
+    # mod_actions must be sorted by timestamp. A group is closed when it
+    # spans more than window_secs or reaches max_items actions.
+    open_groups = {}
+    groups = []
+    for ma in mod_actions:
+        key = group_key(ma)
+        group = open_groups.get(key)
+        if (group is None or len(group) >= max_items
+                or ma.timestamp - group[0].timestamp > window_secs):
+            group = []
+            open_groups[key] = group
+            groups.append(group)
+        group.append(ma)
+    return groups
+
+
+def digest_key(mas):
+    ids = ",".join(ma.id for ma in mas)
+    return "digest_" + hashlib.sha1(ids.encode("utf-8")).hexdigest()
+
+
+# Turns new mod actions into (key, body, formatted_body, timestamp) messages,
+# where key is the mod action id or a digest key built from all ids, and
+# timestamp the time of the (oldest) mod action. Groups of at
+# least `threshold` actions with the same mod, action and place become one
+# digest message, everything else is sent one message per action.
+class Digest:
+    def __init__(self, threshold=DIGEST_THRESHOLD,
+                 window_secs=DIGEST_WINDOW_SECONDS,
+                 max_items=DIGEST_MAX_ITEMS, renderer=None):
+        self.renderer = renderer or render.Renderer()
+        self.threshold = threshold
+        self.window_secs = window_secs
+        self.max_items = max_items
+
+    def render(self, ma, rendered):
+        # rendered caches the bodies of single messages by mod action id, for
+        # routes sharing the renderer
+        if rendered is None:
+            return self.renderer.render(ma)
+        bodies = rendered.get(ma.id)
+        if bodies is None:
+            bodies = rendered[ma.id] = self.renderer.render(ma)
+        return bodies
+
+    def messages(self, mod_actions, rendered=None):
+        if not self.threshold:
+            return [(ma.id,) + self.render(ma, rendered) + (ma.timestamp,)
+                    for ma in mod_actions]
+        msgs = []
+        for group in group_mod_actions(mod_actions, self.window_secs,
+                                       self.max_items):
+            if len(group) >= self.threshold:
+                msgs.append((group[0].timestamp, digest_key(group))
+                            + self.renderer.render_digest(group))
+            else:
+                msgs.extend((ma.timestamp, ma.id) + self.render(ma, rendered)
+                            for ma in group)
+        # stable sort keeps the order of actions within the same second
+        msgs.sort(key=lambda m: m[0])
+        return [m[1:] + m[:1] for m in msgs]
+
+
+def from_config(config, section="digest", renderer=None):
+    renderer = renderer or render.from_config(config)
+    if not config.has_section(section):
+        return Digest(renderer=renderer)
+    cfg = config[section]
+    return Digest(cfg.getint("threshold", fallback=DIGEST_THRESHOLD),
+                  cfg.getint("window_secs", fallback=DIGEST_WINDOW_SECONDS),
+                  cfg.getint("max_items", fallback=DIGEST_MAX_ITEMS),
+                  renderer)
@@ -0,0 +1,84 @@
+from collections import namedtuple
+
+import filters
+from storage import DEFAULT_FEED
+
+
+FEED_SECTION_PREFIX = "feed:"
+FEED_MODES = ("json", "atom")
+# editflair is too noisy to post and is not stored by default
+DEFAULT_EXCLUDE_ACTIONS = "editflair"
+# max pages fetched in one check to catch up after downtime or mass actions
+MAX_CATCHUP_PAGES = 10
+
+
+# name identifies the feed in the db, roomid None means the default
+# [matrixconfig] room. store_filter is the compiled filters.RuleSet applied
+# before storing, filters applied before posting belong to routes.
+# user_agent is sent to Reddit, empty for the default of requests.
+Feed = namedtuple("Feed", [
+    "name", "url", "mode", "roomid", "store_filter", "checktimemins",
+    "max_catchup_pages", "user_agent"])
+
+
+def exclude_actions_rule(name, value):
+    # exclude_actions is a filter rule dropping actions before storing
+    actions = filters.split_list(value)
+    if not actions:
+        return []
+    return [filters.rule("exclude_actions:" + name, {"actions": actions},
+                         feeds={name}, store=False)]
+
+
+def make_feed(name, url, mode, roomid, exclude_actions, checktimemins,
+              max_pages, rules, user_agent=""):
+    if mode == "json":
+        # Atom mod actions have no Reddit action to exclude by
+        rules = exclude_actions_rule(name, exclude_actions) + rules
+    return Feed(name, url, mode, roomid, filters.store_rules(rules, name),
+                checktimemins, max_pages, user_agent)
+
+
+def feed_from_section(name, cfg, program_cfg, rules):
+    mode = cfg.get("mode", fallback="json")
+    if mode not in FEED_MODES:
+        raise Exception("unexpected mode for feed {}: {}".format(name, mode))
+    if mode == "atom" and "exclude_actions" in cfg:
+        raise Exception("feed {}: exclude_actions needs the json mode, Atom"
+                        " mod actions carry no Reddit action".format(name))
+    return make_feed(name, cfg["url"], mode, cfg.get("roomid"),
+                     cfg.get("exclude_actions",
+                             fallback=DEFAULT_EXCLUDE_ACTIONS),
+                     cfg.getint("checktimemins",
+                                fallback=int(program_cfg["checktimemins"])),
+                     cfg.getint("max_catchup_pages",
+                                fallback=max_catchup_pages(program_cfg)),
+                     rules, program_cfg["user_agent"])
+
+
+def max_catchup_pages(program_cfg):
+    return program_cfg.getint("max_catchup_pages", fallback=MAX_CATCHUP_PAGES)
+
+
+# Feeds are read from [feed:NAME] sections. Without any, the single feed
+# configured in [redditmodlog] is used under the name "default", which is
+# also the name its data was migrated to.
+def from_config(config):
+    program_cfg = config["programconfig"]
+    rules = filters.rules_from_config(config)
+    feeds = [feed_from_section(section[len(FEED_SECTION_PREFIX):],
+                               config[section], program_cfg, rules)
+             for section in config.sections()
+             if section.startswith(FEED_SECTION_PREFIX)]
+    if not feeds:
+        cfg = config["redditmodlog"]
+        mode = cfg["mode"]
+        if mode not in FEED_MODES:
+            raise Exception("unexpected mode: " + mode)
+        feeds = [make_feed(DEFAULT_FEED, cfg[mode + "_url"], mode, None,
+                           DEFAULT_EXCLUDE_ACTIONS,
+                           int(program_cfg["checktimemins"]),
+                           max_catchup_pages(program_cfg), rules,
+                           program_cfg["user_agent"])]
+    filters.check_actions(rules, feeds)
+    return feeds
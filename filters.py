@@ -0,0 +1,206 @@
+from collections import namedtuple
+import re
+
+import metrics
+
+
+# Rules that drop mod actions, from [filter:NAME] sections. A rule matches
+# a mod action when all of its conditions do, and a mod action is dropped
+# when any rule matches. Rules are compiled per feed and room into a
+# RuleSet: exact conditions become set lookups, regex conditions one
+# combined regex per field, so the cost per action barely grows with the
+# number of rules. Patterns with groups or inline flags are matched one by
+# one.
+
+
+FILTER_SECTION_PREFIX = "filter:"
+# condition name: ModAction attribute. Mod and subreddit names are compared
+# case-insensitively, like Reddit does.
+EXACT_FIELDS = {"actions": "r_action", "mods": "modname",
+                "places": "place"}
+CASELESS_FIELDS = ("mods", "places")
+REGEX_FIELDS = {"details": "details", "object": "object"}
+
+Rule = namedtuple("Rule", [
+    "name", "exact", "regex", "feeds", "rooms", "store"])
+
+
+def split_list(value):
+    return frozenset(v.strip() for v in value.split(",") if v.strip())
+
+
+def rule(name, exact=None, regex=None, feeds=None, rooms=None, store=True):
+    # exact maps EXACT_FIELDS to sets of values, regex REGEX_FIELDS to
+    # patterns. feeds and rooms limit where the rule applies, store=False
+    # drops matching mod actions before they are stored.
+    exact = dict((field, frozenset(v.lower() for v in values)
+                  if field in CASELESS_FIELDS else frozenset(values))
+                 for field, values in (exact or {}).items() if values)
+    compiled = {}
+    for field, pattern in (regex or {}).items():
+        if not pattern:
+            continue
+        try:
+            compiled[field] = re.compile(pattern)
+        except re.error as e:
+            raise Exception("bad {} regex in filter {}: {}".format(
+                                field, name, e))
+    if not exact and not compiled:
+        raise Exception("filter {} has no conditions".format(name))
+    if rooms and not store:
+        raise Exception("filter {} can not be limited to rooms as it drops"
+                        " mod actions before they are stored".format(name))
+    return Rule(name, exact, compiled, feeds or None, rooms or None, store)
+
+
+def rule_from_section(name, cfg):
+    unknown = (set(cfg) - set(EXACT_FIELDS) - set(REGEX_FIELDS)
+               - {"feeds", "rooms", "store"})
+    # configparser lists the DEFAULT section keys too
+    unknown -= set(cfg.parser.defaults())
+    if unknown:
+        raise Exception("unknown options in filter {}: {}".format(
+                            name, ", ".join(sorted(unknown))))
+    return rule(name,
+                dict((field, split_list(cfg[field]))
+                     for field in EXACT_FIELDS if field in cfg),
+                dict((field, cfg[field])
+                     for field in REGEX_FIELDS if field in cfg),
+                split_list(cfg.get("feeds", "")),
+                split_list(cfg.get("rooms", "")),
+                cfg.getboolean("store", fallback=True))
+
+
+def rules_from_config(config):
+    return [rule_from_section(section[len(FILTER_SECTION_PREFIX):],
+                              config[section])
+            for section in config.sections()
+            if section.startswith(FILTER_SECTION_PREFIX)]
+
+
+def field_value(ma, field):
+    if field in EXACT_FIELDS:
+        value = getattr(ma, EXACT_FIELDS[field])
+        return value.lower() if field in CASELESS_FIELDS else value
+    return getattr(ma, REGEX_FIELDS[field]) or ""
+
+
+def rule_matches(r, ma):
+    return (all(field_value(ma, f) in values for f, values in r.exact.items())
+            and all(regex.search(field_value(ma, f))
+                    for f, regex in r.regex.items()))
+
+
+# flags of a pattern without inline flags
+DEFAULT_FLAGS = re.compile("").flags
+
+
+def combinable(regex):
+    # Patterns with groups or inline flags are matched on their own: joined
+    # into one regex, group numbers shift, which breaks backreferences
+    # silently, and global flags are only allowed at the very start.
+    return not regex.groups and regex.flags == DEFAULT_FLAGS
+
+
+def combine(field, patterns):
+    # one regex of the (rule name, pattern) pairs of patterns
+    try:
+        return re.compile("|".join(p for _, p in patterns))
+    except re.error as e:
+        raise Exception("bad {} regex in filters {}: {}".format(
+                            field, ", ".join(name for name, _ in patterns),
+                            e))
+
+
+class RuleSet:
+    def __init__(self, rules):
+        self.rules = rules
+        # value -> rule name per field, for rules with one exact condition
+        self.lookups = {}
+        # one regex per field with a named group per rule, for rules with
+        # one regex condition
+        patterns = {}
+        self.group_rules = {}
+        # rules with several conditions, or with a regex that can not be
+        # combined, are checked one by one
+        self.general = []
+        for r in rules:
+            if len(r.exact) + len(r.regex) > 1 or not all(
+                    combinable(regex) for regex in r.regex.values()):
+                self.general.append(r)
+            elif r.exact:
+                (field, values), = r.exact.items()
+                lookup = self.lookups.setdefault(field, {})
+                for value in values:
+                    lookup.setdefault(value, r.name)
+            else:
+                (field, regex), = r.regex.items()
+                group = "r{}".format(len(self.group_rules))
+                self.group_rules[group] = r.name
+                patterns.setdefault(field, []).append(
+                    (r.name, "(?P<{}>{})".format(group, regex.pattern)))
+        self.regexes = dict((field, combine(field, ps))
+                            for field, ps in patterns.items())
+
+    def match(self, ma):
+        # name of the first matching rule, or None
+        for field, lookup in self.lookups.items():
+            name = lookup.get(field_value(ma, field))
+            if name:
+                return name
+        for field, regex in self.regexes.items():
+            m = regex.search(field_value(ma, field))
+            if m:
+                return self.group_rules[m.lastgroup]
+        for r in self.general:
+            if rule_matches(r, ma):
+                return r.name
+        return None
+
+    def keep(self, ma):
+        name = self.match(ma)
+        if name:
+            metrics.FILTER_DROPS.inc(rule=name)
+            return False
+        return True
+
+    def filter(self, mod_actions):
+        if not self.rules:
+            return list(mod_actions)
+        return [ma for ma in mod_actions if self.keep(ma)]
+
+
+def check_actions(rules, feed_list):
+    # Atom mod actions carry no Reddit action, an actions condition would
+    # never match them
+    atom = set(feed.name for feed in feed_list if feed.mode == "atom")
+    for r in rules:
+        feeds = atom if r.feeds is None else atom & r.feeds
+        if "actions" in r.exact and feeds:
+            raise Exception("filter {}: actions do not work for the Atom"
+                            " feeds {}, limit it to JSON feeds with"
+                            " feeds=".format(r.name,
+                                             ", ".join(sorted(feeds))))
+
+
+def applies(r, feed, room):
+    return ((r.feeds is None or feed in r.feeds)
+            and (r.rooms is None or room in r.rooms))
+
+
+def store_rules(rules, feed):
+    # rules dropping mod actions of feed before they are stored
+    return RuleSet([r for r in rules
+                    if not r.store and (r.feeds is None or feed in r.feeds)])
+
+
+def post_rules(rules, feed, room):
+    # rules dropping stored mod actions of feed before they are posted to
+    # room. Mod actions dropped before storing never get here.
+    return RuleSet([r for r in rules if r.store and applies(r, feed, room)])
+
+
+def log_hits(logger):
+    for labels, count in metrics.FILTER_DROPS.items():
+        logger.info("filter {} dropped {} mod actions".format(
+                        labels["rule"], count))
@@ -0,0 +1,80 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+
+# Import time of main.py, which every start of the bot and every command
+# pays, from python -X importtime in fresh interpreters. Fails when the
+# median is over the budget or when a dependency that only some modes need
+# is imported up front.
+# Run: python3 importtime.py [--budget MS]
+
+
+MODULE = "main"
+# milliseconds, about twice the time measured when it was set
+BUDGET_MS = 150
+# imported by the code that uses them only: requests by the sync runtime and
+# the commands fetching from Reddit, aiohttp by the async runtime,
+# feedparser by the Atom fallback parser, http.server by the metrics server
+# and multiprocessing by the reprocess command
+LAZY_MODULES = ("requests", "aiohttp", "feedparser", "http.server",
+                "multiprocessing")
+
+
+def import_times(module):
+    # (module, self us, cumulative us) of one import of module
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + module],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        if not self_us.strip().isdigit():
+            continue # the header
+        times.append((name.strip(), int(self_us), int(cumulative_us)))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--budget", type=float, default=BUDGET_MS,
+                        help="milliseconds allowed for importing main")
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument("--top", type=int, default=10,
+                        help="slowest modules to list")
+    args = parser.parse_args()
+
+    runs = [import_times(MODULE) for _ in range(args.repeat)]
+    totals = [dict((name, c) for name, _, c in times)[MODULE] / 1000
+              for times in runs]
+    median = statistics.median(totals)
+    # the modules of the median run
+    _, times = sorted(zip(totals, runs), key=lambda r: r[0])[len(runs) // 2]
+    print("import {}: median {:.1f} ms, min {:.1f} ms, budget {:g} ms".format(
+        MODULE, median, min(totals), args.budget))
+    print("{:<32} {:>8} {:>10}".format("slowest modules", "self ms",
+                                       "total ms"))
+    for name, self_us, cumulative_us in sorted(
+            times, key=lambda t: t[1], reverse=True)[:args.top]:
+        print("{:<32} {:>8.1f} {:>10.1f}".format(name, self_us / 1000,
+                                                 cumulative_us / 1000))
+
+    failed = False
+    imported = set(name for name, _, _ in times)
+    for module in LAZY_MODULES:
+        if module in imported:
+            print("{} is imported by import {}".format(module, MODULE))
+            failed = True
+    if median > args.budget:
+        print("over budget by {:.1f} ms".format(median - args.budget))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
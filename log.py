@@ -1,4 +1,10 @@
 import logzero
 from logzero import logger
 
-logzero.logfile("logs/monitor.log", maxBytes=1e6, backupCount=10)
+LOGFILE = "logs/monitor.log"
+
+
+# Called by main.py, so that tools importing the bot's modules do not write
+# to its log file.
+def setup(logfile=LOGFILE):
+    logzero.logfile(logfile, maxBytes=1e6, backupCount=10)
@@ -1,42 +1,328 @@
+import argparse
+import os
+import sys
 import time
 
+import backfill
 import conf
+import feeds
+import filters
+import log
 from log import logger
 import matrix
+import metrics
+import query
 import reddit
+import routing
+import scheduler
+import storage
+from utils import json_compact
 
 
-def process():
-    mod_actions = reddit.new_mod_actions()
-    for ma in mod_actions:
-        md = reddit.format_mod_action_md(ma)
-        html = reddit.format_mod_action_html(ma)
-        matrix.send_message(md, html)
+def ingest(db, feed, router, page, last_page=True):
+    # new mod actions and their messages for all routes are committed
+    # together, the sender picks the messages up from the outbox. Cache
+    # validators are saved only once the page is stored. Digests group all
+    # mod actions of a check, so while more pages follow the new mod actions
+    # are held in the db and queued with those of the last page. Returns the
+    # new mod actions and whether to fetch the next page now.
+    parsing = metrics.Stopwatch()
+    rendering = metrics.Stopwatch()
+    started = time.perf_counter()
+    with parsing:
+        listing = reddit.parse_page(feed, page, db.saves_raw)
+    with db.transaction():
+        # JSON pages are parsed while they are stored
+        mod_actions = reddit.ingest(db, feed,
+                                    parsing.wrap(listing.mod_actions))
+        more = not last_page and more_pages(db, feed, page, listing)
+        with rendering:
+            if more and router.digests(feed):
+                hold(db, feed, mod_actions)
+            else:
+                queue_messages(db, feed, router, mod_actions)
+        db.set_http_validators(feed.name, page.url, page.etag,
+                               page.last_modified)
+    elapsed = time.perf_counter() - started
+    metrics.STAGE_SECONDS.observe(parsing.seconds, feed=feed.name,
+                                  stage="parse")
+    metrics.STAGE_SECONDS.observe(rendering.seconds, feed=feed.name,
+                                  stage="render")
+    metrics.STAGE_SECONDS.observe(
+        elapsed - parsing.seconds - rendering.seconds, feed=feed.name,
+        stage="store")
+    return mod_actions, more
 
 
-def main_loop():
-    config = conf.config
-    wait_time = int(config["programconfig"]["checktimemins"]) * 60
-    mode = config["redditmodlog"]["mode"]
-    logger.info("starting in '{}' mode, checking every {} seconds".format(
-                    mode, wait_time))
+def hold(db, feed, mod_actions):
+    db.hold_mod_actions(feed.name, [(ma.id, reddit.dump_mod_action(ma))
+                                    for ma in mod_actions])
+
+
+def queue_messages(db, feed, router, mod_actions):
+    # together with the mod actions held by earlier pages of the check, or
+    # by a check that failed before its last page
+    if router.digests(feed):
+        held = [reddit.load_mod_action(data)
+                for data in db.take_held_mod_actions(feed.name)]
+        if held:
+            mod_actions = sorted(held + mod_actions,
+                                 key=lambda ma: ma.timestamp)
+    db.add_to_outbox(router.messages(feed, mod_actions))
+
+
+def release_held(db, feed, router):
+    # for checks that end without a page to queue them with
+    if router.digests(feed):
+        with db.transaction():
+            queue_messages(db, feed, router, [])
+
+
+def more_pages(db, feed, page, listing):
+    # After a full page the next one, newer than the mod actions just stored,
+    # is fetched right away. Stop if the stored page did not move the cursor.
+    return (feed.mode == "json" and reddit.page_full(page, listing)
+            and reddit.poll_url(db, feed) != page.url)
+
+
+def process(db, feed, router, sender):
+    new_count = 0
+    max_pages = max(1, feed.max_catchup_pages)
+    for n in range(1, max_pages + 1):
+        with metrics.STAGE_SECONDS.time(feed=feed.name, stage="fetch"):
+            page = reddit.fetch_page(db, feed)
+        if not page:
+            # not modified since the last check
+            release_held(db, feed, router)
+            sender.notify()
+            break
+        mod_actions, more = ingest(db, feed, router, page, n == max_pages)
+        new_count += len(mod_actions)
+        if not more:
+            # the messages of all pages are queued now
+            sender.notify()
+            break
+    return new_count
+
+
+def poll_failed(feed, schedule, e):
+    wait_sec = schedule.failed(getattr(e, "retry_after", None))
+    metrics.CHECKS.inc(feed=feed.name, result="failed")
+    metrics.RETRY_WAIT_SECONDS.inc(wait_sec, service="reddit")
+    logger.warning("{}: check failed, retrying in {:.0f} s: {}".format(
+                    feed.name, wait_sec, e))
+
+
+def poll_done(feed, schedule, new_count):
+    schedule.advance(new_count)
+    metrics.CHECKS.inc(feed=feed.name, result="new" if new_count else "none")
+    metrics.CHECK_NEW_MOD_ACTIONS.observe(new_count, feed=feed.name)
+    logger.debug("{}: {} new mod actions, next check in {:.0f} s at {}"
+                 " UTC".format(feed.name, new_count, schedule.delay(),
+                               time.strftime("%H:%M:%S", time.gmtime(
+                                   schedule.next_run_time()))))
+
+
+def log_startup(config, feed_list):
+    for feed in feed_list:
+        logger.info("feed '{}' in '{}' mode, checking every {} minutes".format(
+                        feed.name, feed.mode, feed.checktimemins))
     custom_ua = config["programconfig"]["user_agent"]
     if custom_ua:
         logger.info("using User-Agent '{}'".format(custom_ua))
-    if mode == "json" and conf.enabled(config["redditmodlog"]["json_save_raw"]):
+    if conf.enabled(config["redditmodlog"]["json_save_raw"]):
         logger.info("saving of raw JSON is enabled")
 
-    while True:
-        try:
-            process()
-        except Exception as e:
-            logger.exception(e)
-        time.sleep(wait_time)
+
+def main_loop(config):
+    feed_list = feeds.from_config(config)
+    log_startup(config, feed_list)
+
+    db = storage.from_config(config, feed_list)
+    router = routing.from_config(config, feed_list)
+    sender = matrix.from_config(config)
+    sender.start()
+    metrics.from_config(config)
+    schedules = list(zip(scheduler.from_config(config, feed_list), feed_list))
+    try:
+        while True:
+            schedule, feed = min(schedules, key=lambda sf: sf[0].next_run)
+            time.sleep(schedule.delay())
+            try:
+                new_count = process(db, feed, router, sender)
+            except reddit.FetchError as e:
+                poll_failed(feed, schedule, e)
+            except Exception as e:
+                logger.exception(e)
+                poll_failed(feed, schedule, e)
+            else:
+                poll_done(feed, schedule, new_count)
+    finally:
+        sender.stop()
+        db.close()
+        filters.log_hits(logger)
+
+
+def run_backfill(config, feed_names, max_pages):
+    feed_list = feeds.from_config(config)
+    if feed_names:
+        unknown = set(feed_names) - set(feed.name for feed in feed_list)
+        if unknown:
+            raise Exception("unknown feeds: " + ", ".join(sorted(unknown)))
+        feed_list = [feed for feed in feed_list if feed.name in feed_names]
+    db = storage.from_config(config, feed_list)
+    try:
+        for feed in feed_list:
+            backfill.backfill(db, feed, max_pages)
+    finally:
+        db.close()
+
+
+def export_raw(config, output):
+    raw = storage.raw_archive_from_config(config)
+    try:
+        if output:
+            with open(output, "w", encoding="utf-8") as out:
+                count = raw.export_jsonl(out)
+        else:
+            count = raw.export_jsonl(sys.stdout)
+    finally:
+        raw.close()
+    logger.info("exported {} raw mod actions".format(count))
+
+
+def run_reprocess(config, workers, restart):
+    raw_db_file = config["redditmodlog"]["json_raw_dbfile"]
+    if not os.path.exists(raw_db_file):
+        raise Exception("no raw archive at " + raw_db_file)
+    # imported here as the process pool is only needed by this command
+    import reprocess
+    db = storage.from_config(config, [])
+    raw = storage.raw_archive_from_config(config)
+    try:
+        reprocess.reprocess(db, raw, workers, restart)
+    finally:
+        raw.close()
+        db.close()
+
+
+def format_row(row, as_json):
+    if as_json:
+        return json_compact(row._asdict())
+    return "\t".join([reddit.format_timestamp(row.timestamp), row.feed,
+                      row.modname, row.place, row.action, row.object,
+                      row.details, row.link or ""])
+
+
+def run_query(config, args):
+    now = time.time()
+    flt = query.Filters(
+        args.feed, args.mod, args.action, args.place,
+        query.parse_time(args.since, now) if args.since else None,
+        query.parse_time(args.until, now) if args.until else None,
+        args.search)
+    # a query must not create the db
+    db_file = config["redditmodlog"]["dbfile"]
+    if not os.path.exists(db_file):
+        raise Exception("no database at " + db_file)
+    db = storage.from_config(config, [])
+    try:
+        if args.limit:
+            page = query.query_page(db.cur, flt, args.cursor, args.limit)
+            rows = page.rows
+        else:
+            rows = query.iter_mod_actions(db.cur, flt, args.cursor)
+        for row in rows:
+            print(format_row(row, args.json))
+        if args.limit and page.cursor:
+            logger.info("more results, continue with --cursor "
+                        + page.cursor)
+    finally:
+        db.close()
+
+
+def run_migrations(config, dry_run):
+    for name, reports in storage.migrate_from_config(config, dry_run):
+        if not reports:
+            logger.info("{}: schema is up to date".format(name))
+        for r in reports:
+            logger.info("{}: version {} to {}, {}: {} rows, {:.1f} s".format(
+                            name, r.version, r.version + 1, r.description,
+                            r.rows, r.seconds))
+    if dry_run:
+        logger.info("dry run, the upgrades were rolled back")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command")
+    backfill_cmd = commands.add_parser(
+        "backfill", help="store the older mod log history without posting it")
+    backfill_cmd.add_argument("--feed", action="append", dest="feeds",
+                              help="feed to backfill, all feeds by default")
+    backfill_cmd.add_argument("--max-pages", type=int,
+                              help="stop after this many pages")
+    export_cmd = commands.add_parser(
+        "export-raw", help="write the raw mod actions as JSON lines")
+    export_cmd.add_argument("-o", "--output",
+                            help="output file, standard output by default")
+    migrate_cmd = commands.add_parser(
+        "migrate", help="upgrade the databases, which otherwise happens on"
+                        " start")
+    migrate_cmd.add_argument("--dry-run", action="store_true",
+                             help="run and time the upgrades, then roll"
+                                  " them back")
+    reprocess_cmd = commands.add_parser(
+        "reprocess", help="parse the raw mod actions again into the mod log"
+                          " table")
+    reprocess_cmd.add_argument("--workers", type=int,
+                               help="parsing processes, one less than the"
+                                    " CPUs by default")
+    reprocess_cmd.add_argument("--restart", action="store_true",
+                               help="start from the first raw mod action"
+                                    " instead of resuming")
+    query_cmd = commands.add_parser(
+        "query", help="list stored mod actions, newest first")
+    query_cmd.add_argument("--feed")
+    query_cmd.add_argument("--mod", help="moderator name")
+    query_cmd.add_argument("--action", help='for example "remove" or "ban"')
+    query_cmd.add_argument("--place", help="subreddit name")
+    query_cmd.add_argument("--since", help="UTC date and time, unix"
+                           " timestamp or time ago like 7d or 12h")
+    query_cmd.add_argument("--until", help="same formats as --since")
+    query_cmd.add_argument("--search", help="words in the object or details")
+    query_cmd.add_argument("--limit", type=int,
+                           help="results per page, all results by default")
+    query_cmd.add_argument("--cursor", help="continue after a previous page")
+    query_cmd.add_argument("--json", action="store_true",
+                           help="print JSON lines")
+    return parser.parse_args()
 
 
 def main():
+    args = parse_args()
+    log.setup()
+    config = conf.load()
+    runtime = config["programconfig"].get("runtime", fallback="sync")
     try:
-        main_loop()
+        if args.command == "backfill":
+            run_backfill(config, args.feeds, args.max_pages)
+        elif args.command == "export-raw":
+            export_raw(config, args.output)
+        elif args.command == "query":
+            run_query(config, args)
+        elif args.command == "migrate":
+            run_migrations(config, args.dry_run)
+        elif args.command == "reprocess":
+            run_reprocess(config, args.workers, args.restart)
+        elif runtime == "async":
+            # imported here so that aiohttp is only needed in async mode
+            import async_main
+            async_main.run(config)
+        elif runtime == "sync":
+            main_loop(config)
+        else:
+            raise Exception("unexpected runtime: " + runtime)
     except KeyboardInterrupt:
         logger.info("shutting down")
 
@@ -1,18 +1,27 @@
+from collections import namedtuple
+import hashlib
 import json
+import threading
 import time
 
-import requests
-
-import conf
 from log import logger
-from utils import json_compact, request_retrying
+import metrics
+import storage
+from utils import json_compact, parse_retry_after
 
 
-PROGRAM_CONFIG = conf.config["programconfig"]
-CONFIG = conf.config["matrixconfig"]
-POST_SEND_SECONDS = 2
 SEND_RETRY_SECONDS = 5
-SEND_RETRIES = 5
+MAX_BACKOFF_SECONDS = 15 * 60
+SEND_RATE = 2.0 # messages per second before any 429 is seen
+SEND_BURST = 10
+MIN_SEND_RATE = 0.05
+STOP_TIMEOUT_SECONDS = 30
+IDLE_WAIT_SECONDS = 60
+OUTBOX_KEEP_SECONDS = 7 * 24 * 3600
+OUTBOX_PRUNE_INTERVAL_SECONDS = 3600
+# 400 Bad Request and 413 Payload Too Large are caused by the message itself
+REJECTED_STATUSES = (400, 413)
+SERVER_SECTION_PREFIX = "server:"
 
 
 # SPEC: https://matrix.org/docs/spec/client_server/r0.6.0
@@ -29,23 +38,295 @@ def message(body, formatted_body=None):
     return json_compact(msg)
 
 
-def send_message(msg, formatted_msg=None):
-    token = CONFIG["accesstoken"]
-    roomid = CONFIG["roomid"]
-    server_url = CONFIG["server_url"]
-    txid = "m" + str(int(time.time()))
-    send_url = "{}_matrix/client/r0/rooms/{}/send/m.room.message/{}".format(
-            server_url, roomid, txid)
-    headers = {"Authorization": "Bearer " + token}
-    custom_ua = PROGRAM_CONFIG["user_agent"]
-    if custom_ua:
-        headers["User-Agent"] = custom_ua
-    data = message(msg, formatted_msg)
-    logger.info("sending: " + msg)
-    reqfn = lambda url: requests.put(url, data=data, headers=headers)
-    r = request_retrying(reqfn, send_url, SEND_RETRIES, SEND_RETRY_SECONDS)
-    if not r:
-        logger.warning("message not sent: " + msg)
-    # quick sleep hack to not trigger 429 Too Many Requests in the first place
-    time.sleep(POST_SEND_SECONDS)
-    return r
+def room_send_url(server_url, roomid):
+    return "{}_matrix/client/r0/rooms/{}/send/m.room.message/".format(
+            server_url, roomid)
+
+
+def retry_after_seconds(body, headers, default):
+    # Matrix puts the delay in the JSON body, proxies may use the header
+    try:
+        return int(json.loads(body)["retry_after_ms"]) / 1000
+    except (ValueError, KeyError, TypeError):
+        pass
+    retry_after = parse_retry_after(headers.get("Retry-After"))
+    return default if retry_after is None else retry_after
+
+
+# Token bucket whose rate adapts to the homeserver: it is halved on every
+# 429 and slowly grows back to the configured rate on successful sends.
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        # senders to the same homeserver in other threads queue here
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        # take a token and return 0, or return how long to wait for one
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        with self.lock:
+            wait_sec = self.reserve()
+            while wait_sec:
+                time.sleep(wait_sec)
+                wait_sec = self.reserve()
+
+    def throttled(self, retry_after):
+        self.rate = max(MIN_SEND_RATE, self.rate / 2)
+        self.tokens = 0
+        self.blocked_until = time.monotonic() + retry_after
+        logger.info("rate limited, sending at most {:.2f} messages/s after"
+                    " a {} s pause".format(self.rate, retry_after))
+
+    def succeeded(self):
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+
+# A Matrix homeserver the bot posts to, name is None for the one in
+# [matrixconfig]. All rooms on it share its rate limit.
+Homeserver = namedtuple("Homeserver", ["name", "url", "token", "bucket"])
+
+
+def homeserver_from_section(name, cfg):
+    bucket = TokenBucket(cfg.getfloat("send_rate", fallback=SEND_RATE),
+                         cfg.getint("send_burst", fallback=SEND_BURST))
+    return Homeserver(name, cfg["server_url"], cfg["accesstoken"], bucket)
+
+
+def homeservers_from_config(config):
+    servers = {None: homeserver_from_section(None, config["matrixconfig"])}
+    for section in config.sections():
+        if section.startswith(SERVER_SECTION_PREFIX):
+            name = section[len(SERVER_SECTION_PREFIX):]
+            servers[name] = homeserver_from_section(name, config[section])
+    return servers
+
+
+def txid(roomid, key):
+    # The homeserver returns the original event for a repeated transaction
+    # id instead of posting again, so deriving it from the mod action id (or
+    # digest key) makes retries and replays after a restart idempotent.
+    # Transaction ids are scoped to the access token, not the room, so the
+    # room is part of the id; otherwise a mod action routed to two rooms of
+    # one homeserver would only be posted to the first.
+    digest = hashlib.sha1((roomid + "\0" + key).encode("utf-8")).hexdigest()
+    return "rml." + digest
+
+
+def backoff_seconds(attempts):
+    return min(SEND_RETRY_SECONDS * 2 ** (attempts - 1), MAX_BACKOFF_SECONDS)
+
+
+def rate_limited(server, retry_after):
+    name = metrics.server_label(server.name)
+    metrics.RATE_LIMITED.inc(server=name)
+    metrics.RETRY_WAIT_SECONDS.inc(retry_after, service="matrix")
+
+
+def record_result(outbox, msg, status):
+    # status is the HTTP status of the final attempt, or None if the request
+    # failed before getting a response
+    server = metrics.server_label(msg.server)
+    if status == 200:
+        outbox.mark_sent(msg.seq)
+        metrics.MESSAGES.inc(server=server, result="sent")
+        if msg.timestamp:
+            metrics.DELIVERY_LAG_SECONDS.observe(time.time() - msg.timestamp,
+                                                 server=server)
+    elif status in REJECTED_STATUSES:
+        # retrying will not help when the message itself is refused
+        logger.error("message rejected with status {}, dropping: {}".format(
+                        status, msg.body))
+        outbox.mark_rejected(msg.seq)
+        metrics.MESSAGES.inc(server=server, result="rejected")
+    else:
+        attempts = msg.attempts + 1
+        wait_sec = backoff_seconds(attempts)
+        metrics.MESSAGES.inc(server=server, result="failed")
+        metrics.RETRY_WAIT_SECONDS.inc(wait_sec, service="matrix")
+        logger.warning("message not sent (attempt {}), retrying in {} s:"
+                       " {}".format(attempts, wait_sec, msg.body))
+        outbox.postpone(msg.seq, attempts, int(time.time() + wait_sec))
+
+
+# Delivers messages from the outbox table in background threads, oldest
+# first, so that callers never wait for the network. A message stays in the
+# outbox until the homeserver accepts it, which also resumes delivery after a
+# crash or restart. Every destination room has its own thread, so a slow room
+# or homeserver does not hold up the others, and all threads share one
+# requests.Session and its connection pool.
+class Sender:
+    def __init__(self, open_outbox, servers, default_roomid,
+                 user_agent=None):
+        self.open_outbox = open_outbox
+        self.servers = servers
+        self.default_roomid = default_roomid
+        # imported here so that the async runtime, which sends with aiohttp
+        # but shares the rest of this module, does not load requests
+        import requests
+        self.session = requests.Session()
+        if user_agent:
+            self.session.headers["User-Agent"] = user_agent
+        # (server, room) -> Drainer
+        self.drainers = {}
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, name="matrix-sender",
+                                       daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def notify(self):
+        self.wakeup.set()
+        for drainer in list(self.drainers.values()):
+            drainer.wakeup.set()
+
+    def stop(self, timeout=STOP_TIMEOUT_SECONDS):
+        self.stopping = True
+        self.notify()
+        deadline = time.monotonic() + timeout
+        for thread in [self.thread] + [d.thread for d in
+                                       list(self.drainers.values())]:
+            thread.join(max(0, deadline - time.monotonic()))
+        self.session.close()
+
+    def wait(self, seconds):
+        self.wakeup.wait(seconds)
+        self.wakeup.clear()
+
+    def run(self):
+        # Starts a drainer for every destination with pending messages and
+        # prunes the outbox. sqlite connections must be used from the thread
+        # that opened them, so every thread opens its own.
+        outbox = self.open_outbox()
+        pruned = 0
+        try:
+            while not self.stopping:
+                try:
+                    for server, room in outbox.destinations():
+                        self.start_drainer(server, room)
+                    now = time.time()
+                    if now - pruned > OUTBOX_PRUNE_INTERVAL_SECONDS:
+                        outbox.prune(now - OUTBOX_KEEP_SECONDS)
+                        pruned = now
+                    self.wait(IDLE_WAIT_SECONDS)
+                except Exception as e:
+                    logger.exception(e)
+                    self.wait(SEND_RETRY_SECONDS)
+        finally:
+            outbox.close()
+
+    def start_drainer(self, server, room):
+        if (server, room) in self.drainers:
+            return
+        if server not in self.servers:
+            logger.error("messages queued for unknown homeserver {}, add a"
+                         " [server:{}] section to send them".format(
+                             server, server))
+            return
+        drainer = Drainer(self, self.servers[server], room)
+        self.drainers[server, room] = drainer
+        drainer.thread.start()
+
+    def send_message(self, server, roomid, key, msg, formatted_msg=None):
+        with metrics.SEND_SECONDS.time(server=metrics.server_label(
+                                           server.name)):
+            return self.put_message(server, roomid, key, msg,
+                                    formatted_msg)
+
+    def put_message(self, server, roomid, key, msg, formatted_msg=None):
+        import requests
+        url = room_send_url(server.url, roomid) + txid(roomid, key)
+        data = message(msg, formatted_msg)
+        headers = {"Authorization": "Bearer " + server.token}
+        logger.info("sending: " + msg)
+        while not self.stopping:
+            server.bucket.acquire()
+            try:
+                r = self.session.put(url, data=data, headers=headers)
+            except requests.RequestException as e:
+                logger.warning("matrix: request failed: " + str(e))
+                return None
+            if r.status_code == 429:
+                # rate limiting is not an error, wait as long as asked to
+                retry_after = retry_after_seconds(r.text, r.headers,
+                                                  SEND_RETRY_SECONDS)
+                server.bucket.throttled(retry_after)
+                rate_limited(server, retry_after)
+                continue
+            if r.status_code != 200:
+                logger.warning("matrix: response status {}".format(
+                                r.status_code))
+            else:
+                server.bucket.succeeded()
+            return r
+        return None
+
+
+# Sends the messages for one room of one homeserver, in order.
+class Drainer:
+    def __init__(self, sender, server, room):
+        self.sender = sender
+        self.server = server
+        self.room = room
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(
+            target=self.run, daemon=True,
+            name="matrix-sender-{}".format(room or "default"))
+
+    def wait(self, seconds):
+        self.wakeup.wait(seconds)
+        self.wakeup.clear()
+
+    def run(self):
+        outbox = self.sender.open_outbox()
+        try:
+            while not self.sender.stopping:
+                try:
+                    msg = outbox.next_message(self.server.name, self.room)
+                    if msg is None:
+                        self.wait(IDLE_WAIT_SECONDS)
+                        continue
+                    delay = msg.next_attempt - time.time()
+                    if delay > 0:
+                        self.wait(delay)
+                        continue
+                    self.deliver(outbox, msg)
+                except Exception as e:
+                    logger.exception(e)
+                    self.wait(SEND_RETRY_SECONDS)
+        finally:
+            outbox.close()
+
+    def deliver(self, outbox, msg):
+        r = self.sender.send_message(
+                self.server, self.room or self.sender.default_roomid,
+                msg.key, msg.body, msg.formatted_body)
+        record_result(outbox, msg, r.status_code if r is not None else None)
+
+
+def from_config(config):
+    return Sender(lambda: storage.outbox_from_config(config),
+                  homeservers_from_config(config),
+                  config["matrixconfig"]["roomid"],
+                  config["programconfig"]["user_agent"])
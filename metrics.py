@@ -0,0 +1,298 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+import json
+import threading
+import time
+
+from log import logger
+
+
+# Counters and histograms of the hot paths: checks of the feeds, stages of
+# processing a page, sending to Matrix and the time from a mod action to its
+# message being accepted by the homeserver. When metrics_port is set in
+# [programconfig] they are served on /metrics in the Prometheus text format
+# and on /metrics.json as JSON.
+
+
+DEFAULT_HOST = "127.0.0.1"
+# upper bounds of histogram buckets
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+                   5, 10, 30)
+LAG_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 4 * 3600)
+COUNT_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+# all metrics in the order they are served
+REGISTRY = []
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        # label values -> value
+        self.values = {}
+        # updated from the sender threads too
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def items(self):
+        # (labels, value) pairs
+        with self.lock:
+            values = list(self.values.items())
+        return [(dict(zip(self.labels, key)), self.copy(value))
+                for key, value in sorted(values)]
+
+    def copy(self, value):
+        return value
+
+    def reset(self):
+        with self.lock:
+            self.values.clear()
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def text_lines(self):
+        for labels, value in self.items():
+            yield "{}{} {}".format(self.name, label_text(labels), value)
+
+    def json_values(self):
+        return [{"labels": labels, "value": value}
+                for labels, value in self.items()]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=SECONDS_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        # the last count is for values above all buckets
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            h = self.values.get(key)
+            if h is None:
+                h = self.values[key] = [[0] * (len(self.buckets) + 1), 0, 0]
+            h[0][i] += 1
+            h[1] += value
+            h[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def copy(self, value):
+        return [list(value[0]), value[1], value[2]]
+
+    def cumulative(self, counts):
+        # (upper bound, count of values up to it) like Prometheus reports them
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            total += count
+            yield bound, total
+
+    def text_lines(self):
+        for labels, (counts, total, count) in self.items():
+            for bound, n in self.cumulative(counts):
+                yield "{}_bucket{} {}".format(
+                    self.name, label_text(dict(labels, le=bound)), n)
+            yield "{}_sum{} {}".format(self.name, label_text(labels), total)
+            yield "{}_count{} {}".format(self.name, label_text(labels), count)
+
+    def json_values(self):
+        return [{"labels": labels,
+                 "buckets": dict((str(bound), n) for bound, n
+                                 in self.cumulative(counts)),
+                 "sum": total, "count": count}
+                for labels, (counts, total, count) in self.items()]
+
+
+# Hits and misses of functools.lru_cache functions, read from their
+# cache_info() when the metrics are served.
+class CacheLookups(Counter):
+    def __init__(self, name, help):
+        super().__init__(name, help, ("cache", "result"))
+        # name -> cached function
+        self.caches = {}
+
+    def watch(self, name, cached):
+        self.caches[name] = cached
+
+    def items(self):
+        items = []
+        for name, cached in sorted(self.caches.items()):
+            info = cached.cache_info()
+            items.append(({"cache": name, "result": "hit"}, info.hits))
+            items.append(({"cache": name, "result": "miss"}, info.misses))
+        return items
+
+    def reset(self):
+        # the counts can only be reset with the cached values
+        for cached in self.caches.values():
+            cached.cache_clear()
+
+
+# Time spent in with blocks and in getting items from wrapped iterators,
+# for stages like parsing that run interleaved with others.
+class Stopwatch:
+    def __init__(self):
+        self.seconds = 0
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds += time.perf_counter() - self.started
+
+    def wrap(self, iterable):
+        it = iter(iterable)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            finally:
+                self.seconds += time.perf_counter() - started
+            yield item
+
+
+def server_label(name):
+    # homeserver names are None for [matrixconfig]
+    return name or "default"
+
+
+CHECKS = Counter(
+    "modlog_checks_total", "Checks of a feed by result: new, none or failed",
+    ("feed", "result"))
+CHECK_NEW_MOD_ACTIONS = Histogram(
+    "modlog_check_new_mod_actions", "New mod actions found by one check",
+    ("feed",), COUNT_BUCKETS)
+STAGE_SECONDS = Histogram(
+    "modlog_stage_seconds",
+    "Time spent per page in the fetch, parse, store and render stages",
+    ("feed", "stage"))
+FETCHED_MOD_ACTIONS = Counter(
+    "modlog_fetched_mod_actions_total", "Mod actions fetched from Reddit",
+    ("feed",))
+NEW_MOD_ACTIONS = Counter(
+    "modlog_new_mod_actions_total", "New mod actions stored", ("feed",))
+FILTER_DROPS = Counter(
+    "modlog_filter_dropped_total", "Mod actions dropped by each filter",
+    ("rule",))
+RETRY_WAIT_SECONDS = Counter(
+    "modlog_retry_wait_seconds_total",
+    "Time waited before retrying failed or rate limited requests",
+    ("service",))
+SEND_SECONDS = Histogram(
+    "modlog_send_seconds",
+    "Time to send one message, including waits for the rate limit",
+    ("server",))
+RATE_LIMITED = Counter(
+    "modlog_rate_limited_total", "429 responses from a homeserver",
+    ("server",))
+MESSAGES = Counter(
+    "modlog_messages_total",
+    "Messages by the result of a send: sent, rejected or failed",
+    ("server", "result"))
+DELIVERY_LAG_SECONDS = Histogram(
+    "modlog_delivery_lag_seconds",
+    "Time from a mod action to its message being accepted by the homeserver",
+    ("server",), LAG_BUCKETS)
+CACHE_LOOKUPS = CacheLookups(
+    "modlog_cache_lookups_total",
+    "Lookups in the caches of short links and formatted times by result:"
+    " hit or miss")
+
+
+def reset():
+    for metric in REGISTRY:
+        metric.reset()
+
+
+def label_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(
+        name, str(value).replace("\\", "\\\\").replace('"', '\\"')
+                        .replace("\n", "\\n"))
+        for name, value in labels.items()) + "}"
+
+
+def text():
+    lines = []
+    for metric in REGISTRY:
+        lines.append("# HELP {} {}".format(metric.name, metric.help))
+        lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+        lines.extend(metric.text_lines())
+    return "\n".join(lines) + "\n"
+
+
+def as_dict():
+    return dict((metric.name, {"type": metric.kind, "help": metric.help,
+                               "values": metric.json_values()})
+                for metric in REGISTRY)
+
+
+def serve(host, port):
+    # http.server is imported here as it takes longer to import than the
+    # rest of the bot, and only serving the metrics needs it
+    import http.server
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split("?")[0]
+            if path == "/metrics":
+                body = text()
+                content_type = "text/plain; version=0.0.4; charset=utf-8"
+            elif path == "/metrics.json":
+                body = json.dumps(as_dict(), indent=1)
+                content_type = "application/json"
+            else:
+                self.send_error(404)
+                return
+            data = body.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            logger.debug("metrics: " + format % args)
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics",
+                     daemon=True).start()
+    logger.info("serving metrics on http://{}:{}/metrics".format(host, port))
+    return server
+
+
+def from_config(config):
+    # the metrics server, or None when metrics_port is not set
+    cfg = config["programconfig"]
+    port = cfg.getint("metrics_port", fallback=0)
+    if not port:
+        return None
+    return serve(cfg.get("metrics_host", fallback=DEFAULT_HOST), port)
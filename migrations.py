@@ -0,0 +1,109 @@
+from collections import namedtuple
+import time
+
+from log import logger
+
+
+# Ordered schema upgrades of a database. All pending steps run in one
+# transaction, so a failed upgrade leaves the database as it was. A dry run
+# goes through the same steps and rolls them back, reporting the rows each
+# step rewrites and how long it took.
+
+
+# upgrades the schema from version to version + 1, tables are the ones it
+# rewrites
+Step = namedtuple("Step", ["version", "description", "apply", "tables"])
+Step.__new__.__defaults__ = ((),)
+
+StepReport = namedtuple("StepReport", [
+    "version", "description", "rows", "seconds"])
+
+# rows copied at once by copy_rows
+BATCH_SIZE = 1000
+PROGRESS_INTERVAL_SECONDS = 10
+
+
+def schema_version(cur):
+    cur.execute("PRAGMA user_version")
+    return cur.fetchone()[0]
+
+
+def table_rows(cur, tables):
+    rows = 0
+    for table in tables:
+        cur.execute("SELECT name FROM sqlite_master"
+                    " WHERE type='table' AND name=?", (table,))
+        if cur.fetchone():
+            cur.execute('SELECT COUNT(*) FROM "{}"'.format(table))
+            rows += cur.fetchone()[0]
+    return rows
+
+
+def pending_steps(steps, version, target):
+    pending = sorted((s for s in steps if version <= s.version < target),
+                     key=lambda s: s.version)
+    if [s.version for s in pending] != list(range(version, target)):
+        raise Exception("no upgrade path from schema version {} to"
+                        " {}".format(version, target))
+    return pending
+
+
+def copy_rows(cur, select_sql, insert_sql, convert=None, params=()):
+    # For rewrites that need Python for every row: reads and inserts
+    # BATCH_SIZE rows at a time so memory use does not depend on the table
+    # size, and logs progress of long copies.
+    read_cur = cur.connection.cursor()
+    read_cur.execute(select_sql, params)
+    copied = 0
+    started = logged = time.monotonic()
+    try:
+        while True:
+            rows = read_cur.fetchmany(BATCH_SIZE)
+            if not rows:
+                break
+            cur.executemany(insert_sql, map(convert, rows) if convert
+                            else rows)
+            copied += len(rows)
+            now = time.monotonic()
+            if now - logged > PROGRESS_INTERVAL_SECONDS:
+                logger.info("copied {} rows, {:.0f} rows/s".format(
+                                copied, copied / (now - started)))
+                logged = now
+    finally:
+        read_cur.close()
+    return copied
+
+
+def migrate(conn, name, steps, target, dry_run=False):
+    cur = conn.cursor()
+    version = schema_version(cur)
+    if version >= target:
+        return []
+    pending = pending_steps(steps, version, target)
+    reports = []
+    # sqlite3 only opens transactions before data changes, not before the
+    # schema changes the steps start with
+    if conn.in_transaction:
+        conn.commit()
+    cur.execute("BEGIN")
+    try:
+        for step in pending:
+            rows = table_rows(cur, step.tables)
+            logger.info("{}: upgrading schema version {} to {}: {}".format(
+                            name, step.version, step.version + 1,
+                            step.description))
+            started = time.monotonic()
+            step.apply(cur)
+            reports.append(StepReport(step.version, step.description, rows,
+                                      time.monotonic() - started))
+        cur.execute("PRAGMA user_version = " + str(target))
+    except BaseException:
+        conn.rollback()
+        raise
+    if dry_run:
+        conn.rollback()
+    else:
+        conn.commit()
+        logger.info("upgraded database {} to schema version {}".format(
+                        name, target))
+    return reports
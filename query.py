@@ -0,0 +1,135 @@
+from collections import namedtuple
+from datetime import datetime, timezone
+import re
+
+import storage
+
+
+# Read access to the stored mod log: filtered by feed, mod, action, subreddit
+# and time range, full-text search over object and details, newest first.
+# Results are paged with a cursor instead of OFFSET, so reading page n costs
+# the same as reading the first one, and iter_mod_actions streams all pages.
+
+
+PAGE_SIZE = 100
+
+Filters = namedtuple("Filters", [
+    "feed", "modname", "action", "place", "since", "until", "text"])
+Filters.__new__.__defaults__ = (None,) * len(Filters._fields)
+
+# link_text and link are None for mod actions without a link
+ModLogRow = namedtuple("ModLogRow", [
+    "feed", "id", "timestamp", "modname", "place", "action", "object",
+    "details", "link_text", "link"])
+
+# a page of results and the cursor of the next one, None on the last page
+Page = namedtuple("Page", ["rows", "cursor"])
+
+
+def fts_query(text):
+    # every word must match, as a literal: FTS5 operators are not passed on
+    words = text.split()
+    return " ".join('"{}"'.format(w.replace('"', '""')) for w in words)
+
+
+def has_fts(cur):
+    return storage.table_exists(cur, "redditmodlog_fts")
+
+
+def encode_cursor(row):
+    return "{}:{}".format(row[0], row[1])
+
+
+def decode_cursor(cursor):
+    try:
+        ts, seq = cursor.split(":")
+        return int(ts), int(seq)
+    except ValueError:
+        raise Exception("bad cursor: " + cursor)
+
+
+def build_query(cur, filters, cursor, limit):
+    conditions = []
+    params = []
+    table = "redditmodlog m"
+    for column in ("feed", "modname", "action", "place"):
+        value = getattr(filters, column)
+        if value is not None:
+            conditions.append('m."{}"=?'.format(column))
+            params.append(value)
+    if filters.since is not None:
+        conditions.append('m."timestamp">=?')
+        params.append(filters.since)
+    if filters.until is not None:
+        conditions.append('m."timestamp"<?')
+        params.append(filters.until)
+    if filters.text:
+        if has_fts(cur):
+            table += ' JOIN redditmodlog_fts f ON f.rowid=m."seq"'
+            conditions.append("redditmodlog_fts MATCH ?")
+            params.append(fts_query(filters.text))
+        else:
+            for word in filters.text.split():
+                conditions.append('(m."object" LIKE ?'
+                                  ' OR m."details" LIKE ?)')
+                params.extend(["%" + word + "%"] * 2)
+    if cursor:
+        ts, seq = decode_cursor(cursor)
+        conditions.append('(m."timestamp"<? OR (m."timestamp"=?'
+                          ' AND m."seq"<?))')
+        params.extend([ts, ts, seq])
+    sql = ('SELECT m."timestamp", m."seq", m."feed", m."id", m."modname",'
+           ' m."place", m."action", m."object", m."details", m."link_text",'
+           ' m."link" FROM ' + table)
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += ' ORDER BY m."timestamp" DESC, m."seq" DESC LIMIT ?'
+    params.append(limit)
+    return sql, params
+
+
+def row_from_db(row):
+    feed, mid, modname, place, action, object, details, link_text, link = (
+        row[2:])
+    return ModLogRow(feed, mid, row[0], modname, place, action, object,
+                     details, link_text, link)
+
+
+def query_page(cur, filters, cursor=None, page_size=PAGE_SIZE):
+    # one extra row tells whether there is a next page
+    cur.execute(*build_query(cur, filters, cursor, page_size + 1))
+    rows = cur.fetchall()
+    next_cursor = (encode_cursor(rows[page_size - 1])
+                   if len(rows) > page_size else None)
+    return Page([row_from_db(r) for r in rows[:page_size]], next_cursor)
+
+
+def iter_mod_actions(cur, filters, cursor=None, page_size=PAGE_SIZE):
+    while True:
+        page = query_page(cur, filters, cursor, page_size)
+        yield from page.rows
+        if not page.cursor:
+            break
+        cursor = page.cursor
+
+
+RELATIVE_TIME = re.compile(r"^(\d+)([smhdw])$")
+TIME_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+TIME_FORMATS = ("%Y-%m-%d", "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M",
+                "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S")
+
+
+def parse_time(value, now):
+    # a UTC date and time, a unix timestamp, or a time ago like 7d or 12h
+    m = RELATIVE_TIME.match(value)
+    if m:
+        return int(now - int(m.group(1)) * TIME_UNITS[m.group(2)])
+    if value.isdigit():
+        return int(value)
+    for fmt in TIME_FORMATS:
+        try:
+            dt = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        return int(dt.replace(tzinfo=timezone.utc).timestamp())
+    raise Exception("unexpected time: " + value)
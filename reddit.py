@@ -1,36 +1,89 @@
 from collections import namedtuple
-from contextlib import closing
 from datetime import datetime
+from functools import lru_cache
+import io
 import json
-import sqlite3
+import re
+import sys
 import time
 from time import mktime
 from urllib.parse import parse_qs, urlencode, urlparse, urlunparse
+from xml.etree import ElementTree
 
-import feedparser
-import requests
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
-import conf
 from log import logger
-from utils import json_compact, request_retrying
+import metrics
+from utils import chunks, json_compact, parse_retry_after
 
 
-PROGRAM_CONFIG = conf.config["programconfig"]
-CONFIG = conf.config["redditmodlog"]
+# ijson errors are not ValueErrors
+JSON_ERRORS = (ValueError, ijson.JSONError) if ijson else ValueError
 BASE_URL = "https://www.reddit.com"
-FETCH_RETRY_SECONDS = 8
-FETCH_RETRIES = 5
-
-
-ModAction = namedtuple("ModAction", [
-    "id", "timestamp", "modname", "platform", "place", "action", "object",
-    "details", "r_action", "r_link", "raw"])
+# The actions of a burst share posts, threads and seconds, so the values
+# derived from their permalinks and timestamps are cached
+LINK_CACHE_SIZE = 4096
+TIMESTAMP_CACHE_SIZE = 4096
+
+
+# A slotted class rather than a namedtuple with the parsed Reddit object:
+# backfills and multi-feed runs keep thousands of these alive. The raw
+# object is kept as compact JSON, and only when it is going to be saved.
+class ModAction:
+    __slots__ = ("id", "timestamp", "modname", "platform", "place", "action",
+                 "object", "details", "r_action", "r_link", "raw_json",
+                 "parsed_link")
+
+    def __init__(self, id, timestamp, modname, platform, place, action,
+                 object, details, r_action, r_link, raw_json=None):
+        self.id = id
+        self.timestamp = timestamp
+        # few distinct values repeat across all actions
+        self.modname = sys.intern(modname)
+        self.platform = sys.intern(platform)
+        self.place = sys.intern(place)
+        self.action = sys.intern(action)
+        self.object = object
+        self.details = details
+        self.r_action = sys.intern(r_action)
+        self.r_link = r_link
+        self.raw_json = raw_json
+        self.parsed_link = None
+
+    @property
+    def link(self):
+        # (text, url) of the short link to r_link, None without one. Parsed
+        # on first use, only stored and posted actions need it.
+        if self.parsed_link is None and self.r_link:
+            self.parsed_link = short_link(self.r_link)
+        return self.parsed_link
+
+    def __repr__(self):
+        return "ModAction({})".format(", ".join(
+            "{}={!r}".format(f, getattr(self, f)) for f in self.__slots__))
+
+
+# fields of a ModAction without its raw payload
+MOD_ACTION_FIELDS = ModAction.__slots__[:10]
+
+
+def dump_mod_action(ma):
+    # for mod actions held back in the db, see main.ingest
+    return json_compact([getattr(ma, f) for f in MOD_ACTION_FIELDS])
+
+
+def load_mod_action(data):
+    return ModAction(*json.loads(data))
 
 
 def minimal_username(name):
     return name.replace("/u/", "")
 
 
+@lru_cache(maxsize=LINK_CACHE_SIZE)
 def short_link(permalink):
     parsed = urlparse(permalink)
     parts = parsed.path.split("/")
@@ -75,16 +128,16 @@ def drop_prefix(s, p):
         return s.replace(p, "", 1)
 
 
-def split_action_atom(ao):
-    action = ao
-    object = ""
-    for wrong, fixed in MOD_ACTION_FIXES_ATOM.items():
-        if ao.startswith(wrong + " "):
-            action = fixed
-            object = ao.replace(wrong + " ", "", 1)
-            break
+# matches the action words of MOD_ACTION_FIXES_ATOM and the object after them
+ACTION_PREFIX_ATOM = re.compile("({}) (.*)".format(
+    "|".join(map(re.escape, MOD_ACTION_FIXES_ATOM))), re.DOTALL)
 
-    return action, object
+
+def split_action_atom(ao):
+    m = ACTION_PREFIX_ATOM.match(ao)
+    if not m:
+        return ao, ""
+    return MOD_ACTION_FIXES_ATOM[m.group(1)], m.group(2)
 
 
 def mod_action_from_atom(entry):
@@ -101,16 +154,74 @@ def mod_action_from_atom(entry):
     details = ""
     r_action = ""
     r_link = ""
-    raw = ""
     return ModAction(mid, timestamp, modname, platform, place, action, object,
-        details, r_action, r_link, raw)
+        details, r_action, r_link)
 
 
-def mod_actions_from_atom(str_):
-    feed = feedparser.parse(str_)
+def mod_actions_from_feedparser(content):
+    # imported here as it is only needed when the fast Atom parser fails
+    import feedparser
+    feed = feedparser.parse(content)
     return map(mod_action_from_atom, feed.entries)
 
 
+ATOM_NS = "{http://www.w3.org/2005/Atom}"
+
+
+def parse_atom_time(value):
+    # a UTC struct_time like feedparser's updated_parsed
+    return datetime.fromisoformat(value.strip()).utctimetuple()
+
+
+def atom_entries(content):
+    # Yields the fields mod_action_from_atom reads from each entry, shaped
+    # like feedparser entries. Entries are dropped once read, so memory does
+    # not grow with the feed.
+    for _, elem in ElementTree.iterparse(io.BytesIO(content)):
+        if elem.tag != ATOM_NS + "entry":
+            continue
+        category = elem.find(ATOM_NS + "category")
+        entry = AtomEntry({
+            "id": elem.findtext(ATOM_NS + "id").strip(),
+            "updated_parsed": parse_atom_time(
+                elem.findtext(ATOM_NS + "updated")),
+            "authors": [{"name": elem.findtext(ATOM_NS + "author/"
+                                               + ATOM_NS + "name").strip()}],
+            "title_detail": {"value": elem.findtext(ATOM_NS + "title")},
+        })
+        entry.tags = [{"term": category.get("term")}]
+        elem.clear()
+        yield entry
+
+
+class AtomEntry(dict):
+    __slots__ = ("tags",)
+
+
+# errors of the fast parser on XML it does not expect
+ATOM_FAST_ERRORS = (ElementTree.ParseError, AttributeError, TypeError,
+                    ValueError)
+
+
+def mod_actions_from_atom(content):
+    # Reddit's mod log feed is parsed directly with iterparse, which is much
+    # faster than feedparser. feedparser, which copes with any feed, takes
+    # over when the fast parser fails.
+    parsed = set()
+    try:
+        for entry in atom_entries(content):
+            ma = mod_action_from_atom(entry)
+            parsed.add(ma.id)
+            yield ma
+        return
+    except ATOM_FAST_ERRORS as e:
+        logger.warning("unexpected Atom feed, falling back to feedparser: "
+                       + str(e))
+    for ma in mod_actions_from_feedparser(content):
+        if ma.id not in parsed:
+            yield ma
+
+
 MOD_ACTIONS_OBJTYPES = {
     "banuser"       : ("ban", "user"),
     "unbanuser"     : ("unban", "user"),
@@ -129,7 +240,7 @@ MOD_ACTIONS_OBJTYPES = {
 }
 
 
-def mod_action_from_json(obj):
+def mod_action_from_json(obj, keep_raw=True):
     # get required keys with obj[] to trigger KeyErrors
     mid = obj["id"]
     timestamp = int(obj["created_utc"])
@@ -163,238 +274,148 @@ def mod_action_from_json(obj):
 
     object = " ".join(filter(bool, [objtype, author, title]))
     return ModAction(mid, timestamp, modname, platform, place, action,
-        object, details, r_action, r_link, obj)
-
-
-def mod_actions_from_json(str):
-    try:
-        feed = json.loads(str)
-    except ValueError as e:
-        logger.error("malformed JSON")
-        return []
+        object, details, r_action, r_link,
+        json_compact(obj) if keep_raw else None)
+
+
+# One page of a Reddit listing. mod_actions may be an iterator that parses
+# the page as it is consumed, so after (the cursor of the next older page)
+# and size (the number of children) are only final once it is exhausted.
+class Listing:
+    def __init__(self, mod_actions=(), after=None):
+        self.mod_actions = mod_actions
+        self.after = after
+        self.size = len(mod_actions) if isinstance(mod_actions, list) else 0
+
+
+def json_children(content, listing):
+    # yields the children of a JSON listing and sets listing.after
+    if not ijson:
+        feed = json.loads(content)
+        listing.after = feed["data"].get("after")
+        yield from feed["data"]["children"]
+        return
+    # only one child is built at a time instead of the whole tree
+    builder = None
+    children_seen = False
+    for prefix, event, value in ijson.parse(io.BytesIO(content),
+                                            use_float=True):
+        if prefix == "data.after":
+            listing.after = value
+        elif prefix == "data.children" and event == "start_array":
+            children_seen = True
+        elif prefix == "data.children.item" and event == "start_map":
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+        elif builder:
+            builder.event(event, value)
+            if prefix == "data.children.item" and event == "end_map":
+                yield builder.value
+                builder = None
+    if not children_seen:
+        raise KeyError("children")
+
+
+def iter_mod_actions_json(content, listing, keep_raw):
     try:
-        children = feed["data"]["children"]
-        mod_actions = []
-        for c in children:
+        for c in json_children(content, listing):
+            listing.size += 1
             if not c["kind"] == "modaction":
                 logger.warning("unexpected kind: " + c["kind"])
                 continue
             entry = c["data"]
             try:
-                ma = mod_action_from_json(entry)
+                ma = mod_action_from_json(entry, keep_raw)
             except KeyError as e:
                 logger.error("skipping malformed Reddit modaction: "
                              + json.dumps(entry))
                 continue
-            mod_actions.append(ma)
-        return mod_actions
+            yield ma
+    except JSON_ERRORS as e:
+        # ijson adds lines pointing at the error
+        raise ListingError("malformed JSON: " + str(e).split("\n")[0])
     except KeyError as e:
-        logger.error("malformed Reddit modaction Listing, missing key "
-                     + str(e))
-        return []
+        raise ListingError("malformed Reddit modaction Listing, missing key "
+                           + str(e))
 
 
-def filter_mod_actions(mas):
-    return filter(lambda ma: not ma.r_action == "editflair", mas)
+def listing_from_json(content, keep_raw=True):
+    listing = Listing()
+    listing.mod_actions = iter_mod_actions_json(content, listing, keep_raw)
+    return listing
 
 
-def newest_mod_action(mod_actions):
-    return max(mod_actions, key=lambda ma: ma.timestamp)
+def mod_actions_from_json(content, keep_raw=True):
+    return list(listing_from_json(content, keep_raw).mod_actions)
 
 
+def listing_from_atom(content, keep_raw=False):
+    # the Atom feed has no paging cursors
+    return Listing(list(mod_actions_from_atom(content)))
+
+
+@lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
 def format_timestamp(ts):
     return datetime.utcfromtimestamp(ts).isoformat(" ")
 
 
-# modlog v0.12
-def format_mod_action(ma, objlink=""):
-    s = ("{timestamp}; {modname}; {platform} {place};"
-         " {action} {object}{objlink}{details}").format(
-            timestamp=format_timestamp(ma.timestamp),
-            modname=ma.modname,
-            platform=ma.platform,
-            place=ma.place,
-            action=ma.action,
-            object=ma.object,
-            objlink=objlink,
-            details="; " + ma.details if ma.details else "")
-    return s
-
-
-def format_mod_action_md(ma):
-    objlink = ""
-    if ma.r_link:
-        text, link = short_link(ma.r_link)
-        objlink = " ([{}]({}))".format(text, link)
-    return format_mod_action(ma, objlink)
-
-
-def format_mod_action_html(ma):
-    objlink = ""
-    if ma.r_link:
-        text, link = short_link(ma.r_link)
-        objlink = ' (<a href="{}">{}</a>)'.format(link, text)
-    return format_mod_action(ma, objlink)
-
-
-DB_SCHEMA_VERSION = 5
-RAW_DB_SCHEMA_VERSION = 1
-
-
-def table_exists(cur, table):
-    cur.execute("SELECT name FROM sqlite_master"
-                " WHERE type='table' AND name='{}'".format(table))
-    return bool(cur.fetchone())
-
-
-def get_db_value(cur, sql, params=(), converter=None):
-    cur.execute(sql, params)
-    row = cur.fetchone()
-    val = row[0] if row else None
-    return converter(val) if (converter and val is not None) else val
-
-
-def get_meta_value(cur, key, converter):
-    return get_db_value(cur,
-        'SELECT "value" FROM redditmodlog_meta WHERE "key"=?', (key,),
-        converter)
-
-
-def int_or_none(x):
-    return int(x) if x != "" else None
-
-
-def set_meta_value(cur, key, val):
-    cur.execute('UPDATE redditmodlog_meta SET "value"=? WHERE "key"=?',
-                (val, key))
-
-
-def assert_schema_version(cur, required_ver):
-    ver = get_db_value(cur, "PRAGMA user_version", (), int_or_none)
-    if ver != required_ver:
-        raise Exception("unsupported schema version: found {} but"
-                        " expected {}".format(ver, required_ver))
-
-def db_initialized(cur):
-    modlog_table = "redditmodlog"
-    modlog_table_exists = table_exists(cur, modlog_table)
-    meta_table = "redditmodlog_meta"
-    meta_table_exists = table_exists(cur, meta_table)
-    if modlog_table_exists != meta_table_exists:
-        raise Exception("bad db state: tables {} and {} must either both exist"
-                        " or not exist".format(modlog_table, meta_table))
-    if meta_table_exists:
-        # user_version is 0 for empty db files so check it only if table exists
-        assert_schema_version(cur, DB_SCHEMA_VERSION)
-    return modlog_table_exists
-
-
-def raw_db_initialized(cur):
-    exists = table_exists(cur, "redditmodlog_raw")
-    if exists:
-        # user_version is 0 for empty db files so check it only if table exists
-        assert_schema_version(cur, RAW_DB_SCHEMA_VERSION)
-    return exists
-
-
-def get_newest_mod_action_idts(cur):
-    newest_id = get_meta_value(cur, "newest_modaction_id", str)
-    newest_ts = get_meta_value(cur, "newest_modaction_timestamp", int_or_none)
-    return newest_id, newest_ts
-
-
-def update_newest_mod_action(conn, mod_actions):
-    if mod_actions:
-        candidate = newest_mod_action(mod_actions)
-        cur = conn.cursor()
-        newest_id, newest_ts = get_newest_mod_action_idts(cur)
-        if newest_ts and candidate.timestamp < newest_ts:
-            logger.warning("not updating newest mod action as the candidate"
-                           " with id={} and timestamp={} is OLDER than the"
-                           " current one with id={} and timestamp={}".format(
-                           candidate.id, candidate.timestamp,
-                           newest_id, newest_ts))
-            return
-        elif (newest_ts and candidate.timestamp == newest_ts
-              and candidate.id == newest_id):
-            logger.warning("not updating newest mod action with identical"
-                           " id={} and timestamp={}. Bug?".format(
-                           newest_id, newest_ts))
-            return
-        set_meta_value(cur, "newest_modaction_id", candidate.id)
-        set_meta_value(cur, "newest_modaction_timestamp", candidate.timestamp)
-        conn.commit()
-
-
-def init_db(conn):
-    cur = conn.cursor()
-    cur.execute('CREATE TABLE redditmodlog ('
-                '    "id"           TEXT,'
-                '    "timestamp"    INTEGER,'
-                '    "modname"      TEXT,'
-                '    "place"        TEXT,'
-                '    "action"       TEXT,'
-                '    "object"       TEXT,'
-                '    "details"      TEXT,'
-                '    PRIMARY KEY ("id")'
-                ')')
-    cur.execute('CREATE TABLE redditmodlog_meta('
-                '    "key"          TEXT,'
-                '    "value"        TEXT'
-                ')')
-    cur.executemany('INSERT INTO redditmodlog_meta VALUES (?,?)', [
-        ("newest_modaction_id", ""),
-        ("newest_modaction_timestamp", ""),
-    ])
-    cur.execute("PRAGMA user_version = " + str(DB_SCHEMA_VERSION))
-    conn.commit()
-    cur.close()
-    logger.info("initialized database redditmodlog with schema version "
-                + str(DB_SCHEMA_VERSION))
-
-
-def init_raw_db(conn):
-    cur = conn.cursor()
-    cur.execute('CREATE TABLE redditmodlog_raw ('
-                '    "id"           TEXT,'
-                '    "timestamp"    INTEGER,'
-                '    "data"         TEXT,'
-                '    PRIMARY KEY ("id")'
-                ')')
-    cur.execute("PRAGMA user_version = " + str(RAW_DB_SCHEMA_VERSION))
-    conn.commit()
-    cur.close()
-    logger.info("initialized database redditmodlog_raw with schema version "
-                + str(RAW_DB_SCHEMA_VERSION))
-
-
-def mod_action_exists(cur, mid):
-    cur.execute('SELECT "id" FROM redditmodlog WHERE "id"=?', (mid,))
-    return bool(cur.fetchone())
-
-
-def insert_mod_action(cur, ma):
-    cur.execute('INSERT INTO redditmodlog VALUES (?,?,?,?,?,?,?)',
-        (ma.id, ma.timestamp, ma.modname, ma.place, ma.action, ma.object,
-         ma.details))
-
-
-def insert_raw_mod_action(cur, ma):
-    raw = json_compact(ma.raw)
-    cur.execute('INSERT OR IGNORE INTO redditmodlog_raw VALUES (?,?,?)',
-        (ma.id, ma.timestamp, raw))
-
-
-def fetch_resp(url):
-    custom_ua = PROGRAM_CONFIG["user_agent"]
-    headers = {"User-Agent": custom_ua} if custom_ua else {}
-    reqfn = lambda url: requests.get(url, headers=headers)
-    return request_retrying(reqfn, url, FETCH_RETRIES, FETCH_RETRY_SECONDS)
-
-
-def fetch(url):
-    resp = fetch_resp(url)
-    return resp.text if resp else None
+metrics.CACHE_LOOKUPS.watch("short_link", short_link)
+metrics.CACHE_LOOKUPS.watch("format_timestamp", format_timestamp)
+
+
+# shared by all feeds so that connections to Reddit are reused. Created on
+# first use, so that requests is only imported by the sync runtime and the
+# commands fetching from Reddit.
+SESSION = None
+
+
+def get_session():
+    global SESSION
+    if SESSION is None:
+        import requests
+        SESSION = requests.Session()
+        # requests negotiates this by default, be explicit as most of the
+        # bandwidth of a full listing is saved by it
+        SESSION.headers["Accept-Encoding"] = "gzip, deflate"
+    return SESSION
+
+
+# Raised for failed polls, retrying is left to the scheduler. retry_after is
+# the delay asked for by Reddit, if any.
+class FetchError(Exception):
+    def __init__(self, msg, retry_after=None):
+        super().__init__(msg)
+        self.retry_after = retry_after
+
+
+# Raised while parsing a listing that turns out to be truncated or malformed.
+# Listings are newest first, so storing the part read so far would move the
+# poll cursor past the older rest of the page: the transaction of the page is
+# rolled back instead and the check retried like a failed fetch.
+class ListingError(FetchError):
+    pass
+
+
+def fetch_error(url, status, retry_after_header=None):
+    return FetchError("{}: response status {}".format(
+                          urlparse(url).hostname, status),
+                      parse_retry_after(retry_after_header))
+
+
+def fetch_resp(url, headers=None, user_agent=None):
+    import requests
+    headers = dict(headers or {})
+    if user_agent:
+        headers["User-Agent"] = user_agent
+    try:
+        resp = get_session().get(url, headers=headers)
+    except requests.RequestException as e:
+        raise FetchError("{}: request failed: {}".format(
+                             urlparse(url).hostname, e))
+    if resp.status_code not in (200, 304):
+        raise fetch_error(url, resp.status_code,
+                          resp.headers.get("Retry-After"))
+    return resp
 
 
 def replace_query_param(url, param, value):
@@ -405,100 +426,151 @@ def replace_query_param(url, param, value):
     return urlunparse(urlp._replace(query=qs))
 
 
-def save_raw(mod_actions, db_file):
-    with closing(sqlite3.connect(db_file)) as conn:
-        cur = conn.cursor()
-        if not raw_db_initialized(cur):
-            init_raw_db(conn)
-        for ma in mod_actions:
-            insert_raw_mod_action(cur, ma)
-        conn.commit()
+LISTING_PARSERS = {
+    "json": listing_from_json,
+    "atom": listing_from_atom,
+}
+# Reddit's page size when the URL has no limit parameter
+DEFAULT_PAGE_LIMIT = 25
 
 
-def new_mod_actions():
-    db_file = CONFIG["dbfile"]
+def poll_url(storage, feed):
+    if storage.first_run(feed.name):
+        return feed.url
+    newest_id, _ = storage.newest_mod_action_idts(feed.name)
+    return (replace_query_param(feed.url, "before", newest_id)
+            if newest_id else feed.url)
 
-    mode = CONFIG["mode"]
-    if mode == "json":
-        url = CONFIG["json_url"]
-        converter = mod_actions_from_json
-    elif mode == "atom":
-        url = CONFIG["atom_url"]
-        converter = mod_actions_from_atom
-    else:
-        raise Exception("unexpected mode: " + mode)
 
-    db_conn = sqlite3.connect(db_file)
-    db_cur = db_conn.cursor()
+# a fetched listing with its HTTP cache validators
+Page = namedtuple("Page", ["url", "content", "etag", "last_modified"])
 
-    first_run = not db_initialized(db_cur)
-    if first_run:
-        init_db(db_conn)
-        newest_id, newest_ts = None, None
-    else:
-        newest_id, newest_ts = get_newest_mod_action_idts(db_cur)
 
-    url2 = (replace_query_param(url, "before", newest_id)
-            if newest_id else url)
-    resp = fetch(url2)
-    if not resp:
-        db_conn.close()
-        return [] # could not fetch anything, try again later
+def conditional_headers(etag, last_modified):
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    return headers
 
-    mod_actions = sorted(converter(resp), key=lambda ma: ma.timestamp)
 
-    if mode == "json" and conf.enabled(CONFIG["json_save_raw"]):
-        save_raw(mod_actions, CONFIG["json_raw_dbfile"])
+def fetch_page(storage, feed):
+    url = poll_url(storage, feed)
+    headers = conditional_headers(*storage.http_validators(feed.name, url))
+    resp = fetch_resp(url, headers, feed.user_agent)
+    if resp.status_code == 304:
+        logger.debug("{}: not modified".format(feed.name))
+        return None
+    return Page(url, resp.content, resp.headers.get("ETag"),
+                resp.headers.get("Last-Modified"))
 
-    mod_actions_filtered = list(filter_mod_actions(mod_actions))
 
+def parse_page(feed, page, keep_raw=True):
+    # keep_raw keeps the raw JSON of the mod actions for Storage.save_raw
+    return LISTING_PARSERS[feed.mode](page.content, keep_raw)
+
+
+def page_limit(url):
+    limit = parse_qs(urlparse(url).query).get("limit")
+    return int(limit[0]) if limit else DEFAULT_PAGE_LIMIT
+
+
+def page_full(page, listing):
+    # more mod actions may follow a full page
+    return listing.size >= page_limit(page.url)
+
+
+# mod actions are stored in chunks as they are parsed, so only the new ones,
+# without their raw payload, are kept for the whole page
+INGEST_CHUNK_SIZE = 100
+
+
+def ingest(storage, feed, mod_actions):
+    first_run = storage.first_run(feed.name)
     if first_run:
-        for ma in mod_actions_filtered:
-            insert_mod_action(db_cur, ma)
-        update_newest_mod_action(db_conn, mod_actions) # commits
-        db_conn.close()
-        logger.info("saved {} mod actions during first run".format(
-                        len(mod_actions)))
-        return [] # nothing "new" on the first run
+        newest_ts = None
+    else:
+        _, newest_ts = storage.newest_mod_action_idts(feed.name)
 
+    newest = None
+    fetched_count = 0
     new_mod_actions = []
+    new_ids = set()
+    for chunk in chunks(mod_actions, INGEST_CHUNK_SIZE):
+        fetched_count += len(chunk)
+        # mind that we use an _unfiltered_ fetch result to find the newest
+        # seen mod action, to avoid re-checking filtered-out items next time
+        newest = max([newest] + chunk if newest else chunk,
+                     key=lambda ma: ma.timestamp)
+
+        if feed.mode == "json":
+            storage.save_raw(chunk)
+
+        # dropped before any db lookups
+        chunk_filtered = feed.store_filter.filter(chunk)
+
+        if first_run:
+            storage.insert_mod_actions(feed.name, chunk_filtered)
+            continue
+
+        # look up all ids of the chunk at once instead of one SELECT per mod
+        # action
+        known_ids = storage.existing_mod_action_ids(
+                        feed.name, (ma.id for ma in chunk_filtered))
+        chunk_new = []
+
+        for ma in chunk_filtered:
+            exists = ma.id in known_ids or ma.id in new_ids
+            # use < to consider mod actions occurred same second as the newest
+            # seen one. Note that newest_ts may be empty!
+            older = ma.timestamp < newest_ts if newest_ts else False
+
+            if not exists:
+                if older:
+                    logger.warning("fetched mod action is older than the"
+                                   " newest seen one AND is missing from the"
+                                   " db, saving: " + str(ma))
+                new_ids.add(ma.id)
+                chunk_new.append(ma)
+            else: # exists
+                # ideally report a diff with db version
+                if older:
+                    logger.warning("fetched mod action id exists in the db and"
+                                   " its timestamp is older than the newest"
+                                   " seen one. Keeping db version and"
+                                   " ignoring the fetched one: " + str(ma))
+                else:
+                    # maybe update the row but log previous version first
+                    logger.warning("fetched mod action id exists in the db BUT"
+                                   " its timestamp is SAME OR NEWER than the"
+                                   " newest seen one saved in the db. This is"
+                                   " odd. You may have altered the db, or it"
+                                   " is a bug, or Reddit has altered the"
+                                   " timestamp. Newest seen id and timestamp"
+                                   " will be updated in the meta table but the"
+                                   " existing mod action will stay unchanged"
+                                   " in the main table. Fetched version: "
+                                   + str(ma))
+
+        # the caller commits these together with the outbox messages, see
+        # Storage.transaction
+        storage.insert_mod_actions(feed.name, chunk_new)
+        for ma in chunk_new:
+            ma.raw_json = None # already saved
+        new_mod_actions.extend(chunk_new)
+
+    # also on an empty first run, which marks the feed as known so that the
+    # mod actions of its next check are posted
+    storage.update_newest_mod_action(feed.name, [newest] if newest else [])
+    metrics.FETCHED_MOD_ACTIONS.inc(fetched_count, feed=feed.name)
+
+    if first_run:
+        logger.info("{}: saved {} mod actions during first run".format(
+                        feed.name, fetched_count))
+        return [] # nothing "new" on the first run
 
-    for ma in mod_actions_filtered:
-        exists = mod_action_exists(db_cur, ma.id)
-        # use < to consider mod actions occurred same second as the newest
-        # seen one. Note that newest_ts may be empty!
-        older = ma.timestamp < newest_ts if newest_ts else False
-
-        if not exists:
-            if older:
-                logger.warning("fetched mod action is older than the newest"
-                               " seen one AND is missing from the db,"
-                               " saving: " + str(ma))
-            insert_mod_action(db_cur, ma)
-            db_conn.commit()
-            new_mod_actions.append(ma)
-        else: # exists
-            # ideally report a diff with db version
-            if older:
-                logger.warning("fetched mod action id exists in the db and its"
-                               " timestamp is older than the newest seen one."
-                               " Keeping db version and ignoring the fetched"
-                               " one: " + str(ma))
-            else:
-                # maybe update the row but log previous version first
-                logger.warning("fetched mod action id exists in the db BUT its"
-                               " timestamp is SAME OR NEWER than the newest"
-                               " seen one saved in the db. This is odd. You"
-                               " may have altered the db, or it is a bug, or"
-                               " Reddit has altered the timestamp. Newest seen"
-                               " id and timestamp will be updated in the meta"
-                               " table but the existing mod action will stay"
-                               " unchanged in the main table. Fetched version:"
-                               " " + str(ma))
-
-    # mind that we use an _unfiltered_ fetch result to find the newest seen
-    # mod action, to avoid re-checking filtered-out items next time
-    update_newest_mod_action(db_conn, mod_actions) # commits
-
-    db_conn.close()
+    metrics.NEW_MOD_ACTIONS.inc(len(new_mod_actions), feed=feed.name)
+    # listings are newest first, post the oldest first
+    new_mod_actions.sort(key=lambda ma: ma.timestamp)
     return new_mod_actions
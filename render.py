@@ -0,0 +1,118 @@
+from string import Formatter
+
+import reddit
+
+
+# Renders mod actions into message bodies. Everything shared by the plain
+# (markdown) and HTML body of an action, like the timestamp and the short
+# link, is computed once and both bodies are filled from the same fields.
+#
+# Templates are str.format strings and can be set in the optional
+# [templates] section of config.ini. Fields of message, item and
+# digest_header: timestamp, modname, platform, place, action, object, details
+# (with a "; " prefix when not empty) and link, the link_md or link_html
+# template filled with text and url. message also gets item, the rendered
+# item template, and digest_header gets span and count.
+
+
+TEMPLATES = {
+    # modlog v0.12
+    "message": "{timestamp}; {modname}; {platform} {place}; {action} {item}",
+    "item": "{object}{link}{details}",
+    "link_md": " ([{text}]({url}))",
+    "link_html": ' (<a href="{url}">{text}</a>)',
+    "digest_header": "{span}; {modname}; {platform} {place}; {action}"
+                     " x{count}:",
+}
+TEMPLATE_FIELDS = {
+    "message": {"timestamp", "modname", "platform", "place", "action",
+                "object", "details", "link", "item"},
+    "item": {"timestamp", "modname", "platform", "place", "action",
+             "object", "details", "link"},
+    "link_md": {"text", "url"},
+    "link_html": {"text", "url"},
+    "digest_header": {"span", "count", "timestamp", "modname", "platform",
+                      "place", "action", "object", "details", "link"},
+}
+
+
+def template_fields(template):
+    return set(field for _, field, _, _ in Formatter().parse(template)
+               if field is not None)
+
+
+def check_template(name, template):
+    unknown = template_fields(template) - TEMPLATE_FIELDS[name]
+    if unknown:
+        raise Exception("unknown fields in template {}: {}".format(
+                            name, ", ".join(sorted(unknown))))
+
+
+class Renderer:
+    def __init__(self, templates=None):
+        templates = dict(TEMPLATES, **(templates or {}))
+        for name, template in templates.items():
+            check_template(name, template)
+        self.message = templates["message"].format_map
+        self.item = templates["item"].format_map
+        self.link_md = templates["link_md"].format_map
+        self.link_html = templates["link_html"].format_map
+        self.digest_header = templates["digest_header"].format_map
+
+    def fields(self, ma):
+        # the fields of ma, with link left to fill per body
+        return {
+            "timestamp": reddit.format_timestamp(ma.timestamp),
+            "modname": ma.modname,
+            "platform": ma.platform,
+            "place": ma.place,
+            "action": ma.action,
+            "object": ma.object,
+            "details": "; " + ma.details if ma.details else "",
+        }
+
+    def body_fields(self, ma):
+        # the fields of the plain and of the HTML body of ma, items included
+        fields = self.fields(ma)
+        if ma.link:
+            text, url = ma.link
+            link = {"text": text, "url": url}
+            md = dict(fields, link=self.link_md(link))
+            html = dict(fields, link=self.link_html(link))
+        else:
+            md = dict(fields, link="")
+            html = dict(md)
+        md["item"] = self.item(md)
+        html["item"] = self.item(html)
+        return md, html
+
+    def render(self, ma):
+        # (body, formatted_body) of a message for ma
+        md, html = self.body_fields(ma)
+        return self.message(md), self.message(html)
+
+    def render_digest(self, mas):
+        # (body, formatted_body) of one message listing all of mas
+        first, last = mas[0], mas[-1]
+        span = reddit.format_timestamp(first.timestamp)
+        if last.timestamp != first.timestamp:
+            span += " - " + reddit.format_timestamp(last.timestamp)
+        lines = []
+        items_html = []
+        for ma in mas:
+            md, html = self.body_fields(ma)
+            lines.append("- " + md["item"])
+            items_html.append("<li>" + html["item"] + "</li>")
+        fields = self.fields(first)
+        fields.update(span=span, count=len(mas), link="")
+        header = self.digest_header(fields)
+        lines.insert(0, header)
+        return ("\n".join(lines),
+                "{}<ul>{}</ul>".format(header, "".join(items_html)))
+
+
+def from_config(config, section="templates"):
+    if not config.has_section(section):
+        return Renderer()
+    return Renderer(dict((name, config[section][name])
+                         for name in TEMPLATES if name in config[section]))
@@ -0,0 +1,374 @@
+import argparse
+import configparser
+import http.server
+import json
+import os
+import random
+import resource
+import shutil
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qsl, urlparse
+
+import bench
+import feeds
+from main import process
+import matrix
+import metrics
+import reddit
+import routing
+import storage
+
+
+# Replays a mod log through the whole bot, offline. A local Reddit stand-in
+# serves JSON or Atom pages of a mod log that grows by the given number of
+# mod actions before every check, from idle checks to spam waves, and a
+# local homeserver accepts the messages, optionally slowly and with 429
+# responses. Reports throughput, time per stage, peak RSS and SQLite writes.
+# Run: python3 replay.py [--mode atom] [--sizes 0,1,25,1000] [--history 0]
+
+
+# mod actions added before every check
+DEFAULT_SIZES = "0,1,0,5,0,25,1,0,100,0,3,1000,0,0,10"
+# the Atom mod log has no paging and shows the newest entries only
+ATOM_ENTRIES = 100
+# checks after the last size, to catch up after a spam wave
+MAX_EXTRA_CHECKS = 100
+DRAIN_TIMEOUT_SECONDS = 300
+RETRY_AFTER_MS = 100
+
+
+# The mod log served by the Reddit stand-in: items are (JSON object, Atom
+# entry) pairs, oldest first, of which the first `visible` have happened.
+class ModLog:
+    def __init__(self, items):
+        self.items = items
+        self.visible = 0
+
+    def add(self, count):
+        self.visible = min(len(self.items), self.visible + count)
+
+    def newest_first(self):
+        return self.items[self.visible - 1::-1] if self.visible else []
+
+
+def listing_page(items, query, limit):
+    # the part of items (newest first) Reddit serves for query
+    limit = int(query.get("limit", limit))
+    ids = [obj["data"]["id"] for obj, _ in items]
+    if query.get("before") in ids:
+        end = ids.index(query["before"])
+        page = items[max(0, end - limit):end]
+    elif query.get("after") in ids:
+        start = ids.index(query["after"]) + 1
+        page = items[start:start + limit]
+    else:
+        page = items[:limit]
+    after = (page[-1][0]["data"]["id"]
+             if page and page[-1] is not items[-1] else None)
+    return page, after
+
+
+class RedditHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        items = self.server.modlog.newest_first()
+        if url.path.endswith(".rss"):
+            body = bench.atom_page(entry for _, entry
+                                   in items[:ATOM_ENTRIES])
+        else:
+            page, after = listing_page(items, dict(parse_qsl(url.query)),
+                                       self.server.page_limit)
+            body = bench.json_page([obj for obj, _ in page], after)
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Accepts every message after `latency` seconds, except a `rate_limited`
+# fraction that gets a 429 response.
+class HomeserverHandler(http.server.BaseHTTPRequestHandler):
+    def do_PUT(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        with server.lock:
+            limited = server.random.random() < server.rate_limited
+            if limited:
+                server.limited_count += 1
+            else:
+                server.accepted += 1
+        if limited:
+            self.respond(429, {"errcode": "M_LIMIT_EXCEEDED",
+                               "retry_after_ms": RETRY_AFTER_MS})
+        else:
+            self.respond(200, {"event_id": "$replay"})
+
+    def respond(self, status, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(handler, **attrs):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    for name, value in attrs.items():
+        setattr(server, name, value)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Counts statements changing a database, those run by triggers included, and
+# commits, from sqlite's trace callback of every connection it is attached
+# to.
+class WriteCounter:
+    def __init__(self):
+        self.writes = 0
+        self.commits = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, sql):
+        verb = sql.lstrip()[:7].upper()
+        with self.lock:
+            if verb.startswith(("INSERT", "UPDATE", "DELETE", "REPLACE")):
+                self.writes += 1
+            elif verb.startswith("COMMIT"):
+                self.commits += 1
+
+    def attach(self, conn):
+        conn.set_trace_callback(self)
+        return conn
+
+
+def traced_outbox(config, counter):
+    # the sender opens one outbox per thread
+    outbox = storage.outbox_from_config(config)
+    counter.attach(outbox.conn)
+    return outbox
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def synthetic_items(count, mode):
+    return [(bench.json_object(i), bench.atom_entry(i) if mode == "atom"
+             else None) for i in range(count)]
+
+
+def recorded_items(paths):
+    # mod actions of recorded JSON listings, oldest first
+    objs = {}
+    for path in paths:
+        listing = json.loads(bench.read_file(path))
+        for obj in listing["data"]["children"]:
+            objs[obj["data"]["id"]] = obj
+    return [(obj, None) for obj in sorted(
+                objs.values(), key=lambda o: o["data"]["created_utc"])]
+
+
+def replay_config(args, workdir, reddit_port, homeserver_port):
+    config = configparser.ConfigParser()
+    suffix = ".rss" if args.mode == "atom" else ".json"
+    config.read_dict({
+        "programconfig": {
+            "checktimemins": "1",
+            "user_agent": "",
+            "max_catchup_pages": str(args.catchup_pages),
+        },
+        "matrixconfig": {
+            "accesstoken": "replay",
+            "roomid": "!replay:localhost",
+            "server_url": "http://127.0.0.1:{}/".format(homeserver_port),
+            "send_rate": str(args.send_rate),
+            "send_burst": str(max(1, int(args.send_rate))),
+        },
+        "redditmodlog": {
+            "atom_url": "",
+            "json_url": "",
+            "mode": args.mode,
+            "dbfile": os.path.join(workdir, "redditmodlog.sqlite"),
+            "json_save_raw": "true" if args.save_raw else "false",
+            "json_raw_dbfile": os.path.join(workdir,
+                                            "redditmodlog_raw.sqlite"),
+        },
+        "feed:replay": {
+            "url": "http://127.0.0.1:{}/r/replay/about/log/{}".format(
+                       reddit_port, suffix),
+            "mode": args.mode,
+        },
+        "digest": {"threshold": str(args.digest_threshold)},
+    })
+    return config
+
+
+def pending_messages(db):
+    return storage.get_db_value(db.cur, 'SELECT COUNT(*) FROM outbox'
+                                ' WHERE "status"=?',
+                                (storage.OUTBOX_PENDING,))
+
+
+def quantile(histogram_value, buckets, q):
+    # upper bound of the bucket holding the q quantile
+    counts, _, count = histogram_value
+    total = 0
+    for bound, n in zip(buckets + (float("inf"),), counts):
+        total += n
+        if total >= q * count:
+            return bound
+    return float("inf")
+
+
+def stage_lines(histogram, name):
+    for labels, value in histogram.items():
+        counts, total, count = value
+        yield "{:<10} {:>7} {:>10.2f} {:>10}".format(
+            name(labels), count, total / count * 1000,
+            "{:g}".format(quantile(value, histogram.buckets, 0.95) * 1000))
+
+
+def run(args, items):
+    workdir = tempfile.mkdtemp(prefix="replay-")
+    modlog = ModLog(items)
+    reddit_server = serve(RedditHandler, modlog=modlog,
+                          page_limit=args.page_limit)
+    homeserver = serve(HomeserverHandler, latency=args.latency,
+                       rate_limited=args.rate_limited,
+                       random=random.Random(1), lock=threading.Lock(),
+                       accepted=0, limited_count=0)
+    config = replay_config(args, workdir, reddit_server.server_port,
+                           homeserver.server_port)
+    db_writes = WriteCounter()
+    raw_writes = WriteCounter()
+    outbox_writes = WriteCounter()
+    try:
+        feed_list = feeds.from_config(config)
+        feed = feed_list[0]
+        db = storage.from_config(config, feed_list)
+        db_writes.attach(db.conn)
+        if db.raw:
+            raw_writes.attach(db.raw.conn)
+        router = routing.from_config(config, feed_list)
+        sender = matrix.Sender(
+            lambda: traced_outbox(config, outbox_writes),
+            matrix.homeservers_from_config(config),
+            config["matrixconfig"]["roomid"])
+        sender.start()
+
+        # the first check stores the existing mod log without posting it
+        modlog.add(args.history)
+        process(db, feed, router, sender)
+        metrics.reset()
+        rss_before = peak_rss_mb()
+
+        sizes = [int(size) for size in args.sizes.split(",")]
+        started = time.perf_counter()
+        checks = 0
+        new_count = 0
+        for size in sizes:
+            modlog.add(size)
+            new_count += process(db, feed, router, sender)
+            checks += 1
+        for _ in range(MAX_EXTRA_CHECKS):
+            found = process(db, feed, router, sender)
+            checks += 1
+            new_count += found
+            if not found:
+                break
+        ingest_secs = time.perf_counter() - started
+
+        deadline = time.monotonic() + DRAIN_TIMEOUT_SECONDS
+        while pending_messages(db) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        delivery_secs = time.perf_counter() - started
+        pending = pending_messages(db)
+        sender.stop()
+        db.close()
+    finally:
+        reddit_server.shutdown()
+        homeserver.shutdown()
+        shutil.rmtree(workdir)
+
+    sent = homeserver.accepted
+    print("{} mode, {} checks, {} new of {} added mod actions, {} messages"
+          " sent, {} pending".format(args.mode, checks, new_count,
+                                     sum(sizes), sent, pending))
+    print("ingest   {:>10.0f} mod actions/s".format(
+        new_count / ingest_secs if ingest_secs else 0))
+    print("delivery {:>10.1f} messages/s, {} responses were 429".format(
+        sent / delivery_secs if delivery_secs else 0,
+        homeserver.limited_count))
+    print("peak RSS {:>10.1f} MB ({:.1f} MB before the checks)".format(
+        peak_rss_mb(), rss_before))
+    print("SQLite   {} writes and {} commits to the mod log, {} and {} to"
+          " the raw archive, {} and {} by the sender".format(
+              db_writes.writes, db_writes.commits, raw_writes.writes,
+              raw_writes.commits, outbox_writes.writes,
+              outbox_writes.commits))
+    for name, cached in (("links", reddit.short_link),
+                         ("times", reddit.format_timestamp)):
+        info = cached.cache_info()
+        lookups = info.hits + info.misses
+        print("{:<8} {:>10.1%} cache hits of {} lookups".format(
+            name, info.hits / lookups if lookups else 0, lookups))
+    print()
+    print("{:<10} {:>7} {:>10} {:>10}".format("stage", "count", "mean ms",
+                                              "p95 ms"))
+    for line in stage_lines(metrics.STAGE_SECONDS, lambda l: l["stage"]):
+        print(line)
+    for line in stage_lines(metrics.SEND_SECONDS, lambda l: "send"):
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=("json", "atom"), default="json")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES,
+                        help="comma separated mod actions added before each"
+                             " check")
+    parser.add_argument("--history", type=int, default=100,
+                        help="mod actions stored by the first check, 0"
+                             " for a new subreddit with an empty mod log")
+    parser.add_argument("--json", nargs="+", metavar="FILE",
+                        help="recorded JSON listings to replay instead of"
+                             " synthetic mod actions, json mode only")
+    parser.add_argument("--page-limit", type=int,
+                        default=reddit.DEFAULT_PAGE_LIMIT)
+    parser.add_argument("--catchup-pages", type=int,
+                        default=feeds.MAX_CATCHUP_PAGES)
+    parser.add_argument("--digest-threshold", type=int, default=0)
+    parser.add_argument("--save-raw", action="store_true",
+                        help="also store the raw JSON objects")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="seconds the homeserver takes per message")
+    parser.add_argument("--rate-limited", type=float, default=0,
+                        help="fraction of messages answered with 429")
+    parser.add_argument("--send-rate", type=float, default=1000,
+                        help="send_rate of the bot")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    if args.json:
+        if args.mode != "json":
+            parser.error("recorded listings can only be replayed as JSON")
+        items = recorded_items(args.json)
+    else:
+        items = synthetic_items(args.history + sum(sizes), args.mode)
+    run(args, items)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+
+import compression
+from log import logger
+import reddit
+
+
+# Parses the raw archive again into the redditmodlog table, for when
+# mod_action_from_json extracts more or different fields than it did when
+# the rows were stored. Raw rows are read in short queries of
+# storage.RAW_BATCH_SIZE rows, parsed in a pool of worker processes and
+# written back in transactions of BATCH_ROWS mod actions, each saving a
+# checkpoint so an interrupted run resumes after the last transaction. Only
+# mod actions already in redditmodlog are updated, and only where a column
+# changed. The workers run at a lower priority and no query or transaction
+# takes long, so a running bot is not held up.
+
+
+BATCH_ROWS = 10000
+WORKER_NICENESS = 10
+
+# dictionary id -> (codec, data) and Codecs made of them, per worker process
+worker_dicts = None
+worker_codecs = {}
+
+
+def default_workers():
+    # leave a CPU to the writer and the running bot
+    return max(1, (os.cpu_count() or 1) - 1)
+
+
+def init_worker(dictionaries):
+    global worker_dicts
+    worker_dicts = dictionaries
+    os.nice(WORKER_NICENESS)
+
+
+def parse_rows(rows):
+    # (mod actions, ids that failed to parse) of raw (id, dict_id, data) rows
+    mod_actions = []
+    failed = []
+    for mid, dict_id, data in rows:
+        codec = worker_codecs.get(dict_id)
+        if codec is None:
+            codec = compression.Codec(*worker_dicts[dict_id])
+            worker_codecs[dict_id] = codec
+        try:
+            obj = json.loads(codec.decompress(data))
+            ma = reddit.mod_action_from_json(obj, keep_raw=False)
+        except (KeyError, TypeError, ValueError):
+            failed.append(mid)
+            continue
+        # parse the link here rather than in the writing process
+        ma.link
+        mod_actions.append(ma)
+    return mod_actions, failed
+
+
+def parsed_chunks(pool, raw, after, in_flight):
+    # parse_rows results with the (timestamp, id) of the last row of their
+    # chunk, oldest first, keeping up to in_flight chunks in the pool
+    pending = deque()
+    more = True
+    while True:
+        while more and len(pending) < in_flight:
+            rows = raw.rows_after(after)
+            if not rows:
+                more = False
+                break
+            after = rows[-1][:2]
+            pending.append((pool.submit(parse_rows,
+                                        [row[1:] for row in rows]), after))
+        if not pending:
+            return
+        future, last = pending.popleft()
+        yield future.result(), last
+
+
+def reprocess(storage, raw, workers=None, restart=False):
+    if restart:
+        with storage.transaction():
+            storage.set_reprocess_checkpoint(None)
+    checkpoint = storage.reprocess_checkpoint()
+    if checkpoint:
+        logger.info("resuming reprocessing after raw mod action {}".format(
+                        checkpoint[1]))
+    feeds = sorted(feed for feed in storage.known_feeds if feed)
+    workers = workers or default_workers()
+    read = updated = failed = batch_size = 0
+    batch = []
+    with ProcessPoolExecutor(workers, initializer=init_worker,
+                             initargs=(raw.dictionaries(),)) as pool:
+        for (mod_actions, failed_ids), last in parsed_chunks(
+                pool, raw, checkpoint, 2 * workers):
+            for mid in failed_ids:
+                logger.warning("raw mod action {} could not be"
+                               " parsed".format(mid))
+            batch.extend(mod_actions)
+            batch_size += len(mod_actions) + len(failed_ids)
+            failed += len(failed_ids)
+            checkpoint = last
+            if batch_size >= BATCH_ROWS:
+                with storage.transaction():
+                    updated += storage.update_mod_actions(feeds, batch)
+                    storage.set_reprocess_checkpoint(checkpoint)
+                read += batch_size
+                batch = []
+                batch_size = 0
+                logger.info("reprocessed {} raw mod actions, {} rows"
+                            " updated".format(read, updated))
+    with storage.transaction():
+        updated += storage.update_mod_actions(feeds, batch)
+        # done, the next run starts from the first row again
+        storage.set_reprocess_checkpoint(None)
+    read += batch_size
+    logger.info("reprocessing complete: {} raw mod actions, {} rows updated,"
+                " {} could not be parsed".format(read, updated, failed))
+    return updated
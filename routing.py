@@ -0,0 +1,128 @@
+from collections import namedtuple
+
+import digest
+import filters
+import render
+
+
+# Where mod actions are posted. Every [route:NAME] section sends the mod
+# actions of some feeds to one room, with its own filters, templates and
+# digest settings. Without route sections every feed posts to its own room.
+# A mod action is rendered once per set of templates, however many routes
+# use them, and its messages for all routes are queued together.
+
+
+ROUTE_SECTION_PREFIX = "route:"
+
+# server is a [server:NAME] name, None for the [matrixconfig] homeserver.
+# roomid None is the [matrixconfig] room. actions None means all actions.
+# post_filters maps the names of the feeds the route takes mod actions from
+# to their filters.RuleSet.
+Route = namedtuple("Route", [
+    "name", "server", "roomid", "actions", "digester", "post_filters"])
+
+
+class Router:
+    def __init__(self, routes):
+        self.routes = routes
+
+    def digests(self, feed):
+        # whether any route of feed merges mod actions into digests
+        return any(route.digester.threshold for route in self.routes
+                   if feed.name in route.post_filters)
+
+    def messages(self, feed, mod_actions):
+        # (server, room, key, body, formatted_body, timestamp) for all routes
+        # of feed
+        rendered = {}
+        msgs = []
+        for route in self.routes:
+            post_filter = route.post_filters.get(feed.name)
+            if post_filter is None:
+                continue
+            mas = mod_actions
+            if route.actions is not None:
+                mas = [ma for ma in mas if ma.r_action in route.actions]
+            mas = post_filter.filter(mas)
+            if not mas:
+                continue
+            cache = rendered.setdefault(id(route.digester.renderer), {})
+            msgs.extend((route.server, route.roomid) + m
+                        for m in route.digester.messages(mas, cache))
+        return msgs
+
+
+def named_section(config, kind, name):
+    # the [kind:name] section, or [kind] when name is empty
+    section = kind + ":" + name if name else kind
+    if name and not config.has_section(section):
+        raise Exception("section [{}] not found".format(section))
+    return section
+
+
+# Digesters by templates and digest section name, routes with the same
+# templates share one renderer.
+class Formats:
+    def __init__(self, config):
+        self.config = config
+        self.renderers = {}
+        self.digesters = {}
+
+    def digester(self, templates="", digest_name=""):
+        key = (templates, digest_name)
+        if key not in self.digesters:
+            if templates not in self.renderers:
+                self.renderers[templates] = render.from_config(
+                    self.config, named_section(self.config, "templates",
+                                               templates))
+            self.digesters[key] = digest.from_config(
+                self.config, named_section(self.config, "digest",
+                                           digest_name),
+                self.renderers[templates])
+        return self.digesters[key]
+
+
+def route_from_section(name, cfg, feed_list, rules, formats):
+    server = cfg.get("server") or None
+    if server:
+        named_section(cfg.parser, "server", server)
+    roomid = cfg["roomid"]
+    feed_names = filters.split_list(cfg.get("feeds", ""))
+    unknown = feed_names - set(feed.name for feed in feed_list)
+    if unknown:
+        raise Exception("route {}: unknown feeds: {}".format(
+                            name, ", ".join(sorted(unknown))))
+    actions = filters.split_list(cfg.get("actions", "")) or None
+    atom = sorted(feed.name for feed in feed_list if feed.mode == "atom"
+                  and (not feed_names or feed.name in feed_names))
+    if actions and atom:
+        raise Exception("route {}: actions do not work for the Atom feeds {},"
+                        " limit it to JSON feeds with feeds=".format(
+                            name, ", ".join(atom)))
+    return Route(name, server, roomid, actions,
+                 formats.digester(cfg.get("templates", ""),
+                                  cfg.get("digest", "")),
+                 dict((feed.name, filters.post_rules(rules, feed.name,
+                                                     roomid))
+                      for feed in feed_list
+                      if not feed_names or feed.name in feed_names))
+
+
+def feed_route(feed, rules, formats, default_roomid):
+    return Route(feed.name, None, feed.roomid, None, formats.digester(),
+                 {feed.name: filters.post_rules(
+                      rules, feed.name, feed.roomid or default_roomid)})
+
+
+def from_config(config, feed_list):
+    rules = filters.rules_from_config(config)
+    formats = Formats(config)
+    default_roomid = config["matrixconfig"]["roomid"]
+    routes = [route_from_section(section[len(ROUTE_SECTION_PREFIX):],
+                                 config[section], feed_list, rules, formats)
+              for section in config.sections()
+              if section.startswith(ROUTE_SECTION_PREFIX)]
+    if not routes:
+        routes = [feed_route(feed, rules, formats, default_roomid)
+                  for feed in feed_list]
+    return Router(routes)
@@ -0,0 +1,86 @@
+import random
+import time
+
+
+POLL_JITTER_SECONDS = 5
+# multiply the interval by this after a poll without new mod actions
+IDLE_FACTOR = 1.5
+ERROR_BACKOFF_SECONDS = 8
+MAX_ERROR_BACKOFF_SECONDS = 30 * 60
+
+
+# Polling schedule of one feed. The interval adapts between min_interval and
+# max_interval: it is halved after polls that found new mod actions and
+# grows while polls find nothing. With equal bounds it stays fixed.
+#
+# Runs do not drift: a slow poll does not shift later ones, and runs missed
+# while busy are skipped. A random jitter is added to every run. Failed polls
+# are retried with exponential backoff, or after the delay the server asked
+# for, instead of waiting for the next regular run.
+class Schedule:
+    def __init__(self, interval, min_interval=None, max_interval=None,
+                 offset=0, jitter=POLL_JITTER_SECONDS):
+        self.min_interval = min_interval or interval
+        self.max_interval = max(max_interval or interval, self.min_interval)
+        self.interval = min(max(interval, self.min_interval),
+                            self.max_interval)
+        self.jitter = jitter
+        self.errors = 0
+        self.base = time.monotonic() + offset
+        self.next_run = self.base
+
+    def delay(self):
+        return max(0, self.next_run - time.monotonic())
+
+    def next_run_time(self):
+        # wall clock time of the next run
+        return time.time() + self.delay()
+
+    def adapt(self, new_count):
+        if new_count:
+            self.interval = max(self.min_interval, self.interval / 2)
+        else:
+            self.interval = min(self.max_interval,
+                                self.interval * IDLE_FACTOR)
+
+    def advance(self, new_count=0):
+        now = time.monotonic()
+        if self.errors:
+            # resume the regular schedule from now after recovering
+            self.errors = 0
+            self.base = now
+        self.adapt(new_count)
+        self.base += self.interval
+        if self.base < now:
+            self.base += ((now - self.base) // self.interval + 1) \
+                         * self.interval
+        self.next_run = self.base + random.uniform(0, self.jitter)
+
+    def failed(self, retry_after=None):
+        self.errors += 1
+        if retry_after is None:
+            retry_after = min(ERROR_BACKOFF_SECONDS * 2 ** (self.errors - 1),
+                              MAX_ERROR_BACKOFF_SECONDS)
+        self.next_run = time.monotonic() + retry_after
+        return retry_after
+
+
+def staggered(feeds, min_interval=None, max_interval=None,
+              jitter=POLL_JITTER_SECONDS):
+    # spread the first runs over the interval so that feeds are not all
+    # polled at the same moment
+    schedules = []
+    for i, feed in enumerate(feeds):
+        interval = feed.checktimemins * 60
+        schedules.append(Schedule(interval, min_interval, max_interval,
+                                  interval * i / len(feeds), jitter))
+    return schedules
+
+
+def from_config(config, feeds):
+    cfg = config["programconfig"]
+    return staggered(feeds,
+                     cfg.getfloat("min_check_secs", fallback=None),
+                     cfg.getfloat("max_check_secs", fallback=None),
+                     cfg.getfloat("poll_jitter_secs",
+                                  fallback=POLL_JITTER_SECONDS))
@@ -0,0 +1,1033 @@
+from collections import namedtuple
+from contextlib import contextmanager
+import os
+import sqlite3
+import time
+
+import compression
+import conf
+from log import logger
+import migrations
+
+
+DB_SCHEMA_VERSION = 12
+RAW_DB_SCHEMA_VERSION = 3
+# feed name given to the data of the single feed configured before
+# schema version 7
+DEFAULT_FEED = "default"
+# redditmodlog_meta rows of reprocess.py, which are not about one feed
+REPROCESS_META_FEED = ""
+
+
+def table_exists(cur, table):
+    cur.execute("SELECT name FROM sqlite_master"
+                " WHERE type='table' AND name='{}'".format(table))
+    return bool(cur.fetchone())
+
+
+def get_db_value(cur, sql, params=(), converter=None):
+    cur.execute(sql, params)
+    row = cur.fetchone()
+    val = row[0] if row else None
+    return converter(val) if (converter and val is not None) else val
+
+
+def get_meta_value(cur, feed, key, converter):
+    return get_db_value(cur,
+        'SELECT "value" FROM redditmodlog_meta WHERE "feed"=? AND "key"=?',
+        (feed, key), converter)
+
+
+def int_or_none(x):
+    return int(x) if x != "" else None
+
+
+def set_meta_value(cur, feed, key, val):
+    cur.execute('INSERT OR REPLACE INTO redditmodlog_meta VALUES (?,?,?)',
+                (feed, key, val))
+
+
+def get_meta_feeds(cur):
+    cur.execute('SELECT DISTINCT "feed" FROM redditmodlog_meta')
+    return set(row[0] for row in cur.fetchall())
+
+
+def assert_schema_version(cur, required_ver):
+    ver = get_db_value(cur, "PRAGMA user_version", (), int_or_none)
+    if ver != required_ver:
+        raise Exception("unsupported schema version: found {} but"
+                        " expected {}".format(ver, required_ver))
+
+
+# The upgrade steps spell out the schema of their version instead of
+# calling the create_* helpers below, which always make the current schema:
+# a later change to a helper must not change what an old step produces.
+
+
+def upgrade_db_5_to_6(cur):
+    cur.execute('CREATE TABLE outbox ('
+                '    "seq"            INTEGER PRIMARY KEY AUTOINCREMENT,'
+                '    "key"            TEXT UNIQUE,'
+                '    "created"        INTEGER,'
+                '    "body"           TEXT,'
+                '    "formatted_body" TEXT,'
+                '    "status"         TEXT,'
+                '    "attempts"       INTEGER,'
+                '    "next_attempt"   INTEGER,'
+                '    "sent"           INTEGER'
+                ')')
+
+
+def upgrade_db_6_to_7(cur):
+    # existing data belongs to the single feed configured so far. Tables are
+    # rebuilt as their primary keys change. "seq" takes over the rowids of
+    # the mod log, which VACUUM may change while they are implicit.
+    cur.execute('CREATE TABLE redditmodlog_new ('
+                '    "seq"          INTEGER PRIMARY KEY,'
+                '    "feed"         TEXT,'
+                '    "id"           TEXT,'
+                '    "timestamp"    INTEGER,'
+                '    "modname"      TEXT,'
+                '    "place"        TEXT,'
+                '    "action"       TEXT,'
+                '    "object"       TEXT,'
+                '    "details"      TEXT,'
+                '    UNIQUE ("feed", "id")'
+                ')')
+    cur.execute('CREATE TABLE redditmodlog_meta_new ('
+                '    "feed"         TEXT,'
+                '    "key"          TEXT,'
+                '    "value"        TEXT,'
+                '    PRIMARY KEY ("feed", "key")'
+                ')')
+    cur.execute('INSERT INTO redditmodlog_new SELECT rowid, ?, "id",'
+                ' "timestamp", "modname", "place", "action", "object",'
+                ' "details" FROM redditmodlog', (DEFAULT_FEED,))
+    cur.execute('INSERT INTO redditmodlog_meta_new'
+                ' SELECT ?, "key", "value" FROM redditmodlog_meta',
+                (DEFAULT_FEED,))
+    # pending messages of the old outbox go to the default room
+    cur.execute('CREATE TABLE outbox_new ('
+                '    "seq"            INTEGER PRIMARY KEY AUTOINCREMENT,'
+                '    "room"           TEXT,'
+                '    "key"            TEXT,'
+                '    "created"        INTEGER,'
+                '    "body"           TEXT,'
+                '    "formatted_body" TEXT,'
+                '    "status"         TEXT,'
+                '    "attempts"       INTEGER,'
+                '    "next_attempt"   INTEGER,'
+                '    "sent"           INTEGER,'
+                '    UNIQUE ("room", "key")'
+                ')')
+    copy_outbox(cur, '"seq", NULL, "key", "created", "body",'
+                     ' "formatted_body", "status", "attempts",'
+                     ' "next_attempt", "sent"')
+    for table in ("redditmodlog", "redditmodlog_meta", "outbox"):
+        cur.execute('DROP TABLE ' + table)
+        cur.execute('ALTER TABLE {0}_new RENAME TO {0}'.format(table))
+    # UNIQUE does not cover the default room, as SQLite treats NULLs as
+    # distinct from each other
+    cur.execute('CREATE UNIQUE INDEX outbox_key ON outbox'
+                ' (COALESCE("room", \'\'), "key")')
+
+
+def upgrade_db_7_to_8(cur):
+    cur.execute('CREATE INDEX redditmodlog_timestamp'
+                ' ON redditmodlog ("timestamp")')
+    for column in ("modname", "action", "place"):
+        cur.execute('CREATE INDEX redditmodlog_{0}'
+                    ' ON redditmodlog ("{0}", "timestamp")'.format(column))
+    if not fts5_available(cur):
+        logger.warning("SQLite has no FTS5, text search will be slow")
+        return
+    cur.execute("CREATE VIRTUAL TABLE redditmodlog_fts USING fts5("
+                " object, details, content='redditmodlog',"
+                " content_rowid='seq')")
+    cur.execute("CREATE TRIGGER redditmodlog_fts_insert AFTER INSERT"
+                " ON redditmodlog BEGIN"
+                " INSERT INTO redditmodlog_fts(rowid, object, details)"
+                " VALUES (new.seq, new.object, new.details); END")
+    cur.execute("CREATE TRIGGER redditmodlog_fts_delete AFTER DELETE"
+                " ON redditmodlog BEGIN"
+                " INSERT INTO redditmodlog_fts(redditmodlog_fts, rowid,"
+                " object, details)"
+                " VALUES ('delete', old.seq, old.object, old.details); END")
+    cur.execute("CREATE TRIGGER redditmodlog_fts_update AFTER UPDATE"
+                " ON redditmodlog BEGIN"
+                " INSERT INTO redditmodlog_fts(redditmodlog_fts, rowid,"
+                " object, details)"
+                " VALUES ('delete', old.seq, old.object, old.details);"
+                " INSERT INTO redditmodlog_fts(rowid, object, details)"
+                " VALUES (new.seq, new.object, new.details); END")
+    cur.execute("INSERT INTO redditmodlog_fts(redditmodlog_fts)"
+                " VALUES ('rebuild')")
+
+
+def upgrade_db_8_to_9(cur):
+    # messages queued so far go to the default homeserver
+    cur.execute('CREATE TABLE outbox_new ('
+                '    "seq"            INTEGER PRIMARY KEY AUTOINCREMENT,'
+                '    "server"         TEXT,'
+                '    "room"           TEXT,'
+                '    "key"            TEXT,'
+                '    "created"        INTEGER,'
+                '    "body"           TEXT,'
+                '    "formatted_body" TEXT,'
+                '    "status"         TEXT,'
+                '    "attempts"       INTEGER,'
+                '    "next_attempt"   INTEGER,'
+                '    "sent"           INTEGER,'
+                '    UNIQUE ("server", "room", "key")'
+                ')')
+    copy_outbox(cur, ", ".join('"{}"'.format(c) for c in OUTBOX_COLUMNS_V7))
+    cur.execute("DROP TABLE outbox")
+    cur.execute("ALTER TABLE outbox_new RENAME TO outbox")
+    cur.execute('CREATE INDEX outbox_destination ON outbox'
+                ' ("status", "server", "room", "seq")')
+    cur.execute('CREATE UNIQUE INDEX outbox_key ON outbox'
+                ' (COALESCE("server", \'\'), COALESCE("room", \'\'), "key")')
+
+
+def upgrade_db_9_to_10(cur):
+    cur.execute('ALTER TABLE outbox ADD COLUMN "timestamp" INTEGER')
+
+
+def upgrade_db_10_to_11(cur):
+    cur.execute('ALTER TABLE redditmodlog ADD COLUMN "link_text" TEXT')
+    cur.execute('ALTER TABLE redditmodlog ADD COLUMN "link" TEXT')
+
+
+def upgrade_db_11_to_12(cur):
+    cur.execute('CREATE TABLE digest_held ('
+                '    "feed"         TEXT,'
+                '    "id"           TEXT,'
+                '    "data"         TEXT,'
+                '    PRIMARY KEY ("feed", "id")'
+                ')')
+
+
+DB_MIGRATIONS = [
+    migrations.Step(5, "add the outbox", upgrade_db_5_to_6),
+    migrations.Step(6, "add feed names", upgrade_db_6_to_7,
+                    ("redditmodlog", "redditmodlog_meta", "outbox")),
+    migrations.Step(7, "add query indexes and full-text search",
+                    upgrade_db_7_to_8, ("redditmodlog",)),
+    migrations.Step(8, "add outbox homeservers", upgrade_db_8_to_9,
+                    ("outbox",)),
+    migrations.Step(9, "add mod action times to the outbox",
+                    upgrade_db_9_to_10),
+    migrations.Step(10, "add short links of mod actions",
+                    upgrade_db_10_to_11),
+    migrations.Step(11, "hold mod actions for digests", upgrade_db_11_to_12),
+]
+
+
+def upgrade_db(cur, dry_run=False):
+    return migrations.migrate(cur.connection, "redditmodlog", DB_MIGRATIONS,
+                              DB_SCHEMA_VERSION, dry_run)
+
+
+def db_initialized(cur):
+    modlog_table = "redditmodlog"
+    modlog_table_exists = table_exists(cur, modlog_table)
+    meta_table = "redditmodlog_meta"
+    meta_table_exists = table_exists(cur, meta_table)
+    if modlog_table_exists != meta_table_exists:
+        raise Exception("bad db state: tables {} and {} must either both exist"
+                        " or not exist".format(modlog_table, meta_table))
+    if meta_table_exists:
+        # user_version is 0 for empty db files so check it only if table exists
+        upgrade_db(cur)
+        assert_schema_version(cur, DB_SCHEMA_VERSION)
+    return modlog_table_exists
+
+
+# rows read at once by RawArchive.iter_rows
+RAW_BATCH_SIZE = 1000
+# rows a compression dictionary is trained on
+RAW_TRAIN_SAMPLES = 1000
+
+
+def create_raw_tables(cur):
+    # dict_id is the compression dictionary the data is compressed with
+    cur.execute('CREATE TABLE redditmodlog_raw ('
+                '    "id"           TEXT,'
+                '    "timestamp"    INTEGER,'
+                '    "dict_id"      INTEGER,'
+                '    "data"         BLOB,'
+                '    PRIMARY KEY ("id")'
+                ')')
+    cur.execute('CREATE TABLE redditmodlog_raw_dicts ('
+                '    "id"           INTEGER PRIMARY KEY,'
+                '    "codec"        TEXT,'
+                '    "trained"      INTEGER,'
+                '    "created"      INTEGER,'
+                '    "data"         BLOB'
+                ')')
+
+
+def create_raw_index(cur):
+    # rows are exported and reprocessed oldest first
+    cur.execute('CREATE INDEX redditmodlog_raw_timestamp'
+                ' ON redditmodlog_raw ("timestamp", "id")')
+
+
+def insert_raw_dict(cur, codec, trained, data):
+    cur.execute('INSERT INTO redditmodlog_raw_dicts ("codec", "trained",'
+                ' "created", "data") VALUES (?,?,?,?)',
+                (codec, int(trained), int(time.time()), data))
+    return cur.lastrowid
+
+
+def upgrade_raw_db_1_to_2(cur):
+    # compress every row with a dictionary trained on the newest rows
+    cur.execute('SELECT "data" FROM redditmodlog_raw'
+                ' ORDER BY "timestamp" DESC LIMIT ?', (RAW_TRAIN_SAMPLES,))
+    samples = [row[0].encode("utf-8") for row in cur.fetchall()][::-1]
+    cur.execute('CREATE TABLE redditmodlog_raw_new ('
+                '    "id"           TEXT,'
+                '    "timestamp"    INTEGER,'
+                '    "dict_id"      INTEGER,'
+                '    "data"         BLOB,'
+                '    PRIMARY KEY ("id")'
+                ')')
+    cur.execute('CREATE TABLE redditmodlog_raw_dicts ('
+                '    "id"           INTEGER PRIMARY KEY,'
+                '    "codec"        TEXT,'
+                '    "trained"      INTEGER,'
+                '    "created"      INTEGER,'
+                '    "data"         BLOB'
+                ')')
+    codec_name = compression.default_codec()
+    dictionary = (compression.train_dictionary(codec_name, samples)
+                  if samples else compression.SEED_DICT)
+    dict_id = insert_raw_dict(cur, codec_name,
+                              len(samples) >= RAW_TRAIN_SAMPLES, dictionary)
+    codec = compression.Codec(codec_name, dictionary)
+    migrations.copy_rows(
+        cur, 'SELECT "id", "timestamp", "data" FROM redditmodlog_raw',
+        'INSERT INTO redditmodlog_raw_new VALUES (?,?,?,?)',
+        lambda row: (row[0], row[1], dict_id,
+                     codec.compress(row[2].encode("utf-8"))))
+    cur.execute('DROP TABLE redditmodlog_raw')
+    cur.execute('ALTER TABLE redditmodlog_raw_new RENAME TO redditmodlog_raw')
+
+
+def upgrade_raw_db_2_to_3(cur):
+    cur.execute('CREATE INDEX redditmodlog_raw_timestamp'
+                ' ON redditmodlog_raw ("timestamp", "id")')
+
+
+RAW_DB_MIGRATIONS = [
+    migrations.Step(1, "compress raw data", upgrade_raw_db_1_to_2,
+                    ("redditmodlog_raw",)),
+    migrations.Step(2, "index raw data by time", upgrade_raw_db_2_to_3,
+                    ("redditmodlog_raw",)),
+]
+
+
+def upgrade_raw_db(cur, dry_run=False):
+    reports = migrations.migrate(cur.connection, "redditmodlog_raw",
+                                 RAW_DB_MIGRATIONS, RAW_DB_SCHEMA_VERSION,
+                                 dry_run)
+    if not dry_run and any(r.version == 1 for r in reports):
+        # give the space of the table rewritten by the compression step back
+        # to the file system
+        cur.execute("VACUUM")
+    return reports
+
+
+def raw_db_initialized(cur):
+    exists = table_exists(cur, "redditmodlog_raw")
+    if exists:
+        # user_version is 0 for empty db files so check it only if table exists
+        upgrade_raw_db(cur)
+        assert_schema_version(cur, RAW_DB_SCHEMA_VERSION)
+    return exists
+
+
+def get_http_validators(cur, feed, url):
+    # validators are only valid for the exact URL they were received for
+    if get_meta_value(cur, feed, "http_url", str) != url:
+        return None, None
+    return (get_meta_value(cur, feed, "http_etag", str),
+            get_meta_value(cur, feed, "http_last_modified", str))
+
+
+def set_http_validators(cur, feed, url, etag, last_modified):
+    set_meta_value(cur, feed, "http_url", url)
+    set_meta_value(cur, feed, "http_etag", etag or "")
+    set_meta_value(cur, feed, "http_last_modified", last_modified or "")
+
+
+def newest_mod_action(mod_actions):
+    return max(mod_actions, key=lambda ma: ma.timestamp)
+
+
+def get_newest_mod_action_idts(cur, feed):
+    newest_id = get_meta_value(cur, feed, "newest_modaction_id", str)
+    newest_ts = get_meta_value(cur, feed, "newest_modaction_timestamp",
+                               int_or_none)
+    return newest_id, newest_ts
+
+
+def update_newest_mod_action(cur, feed, mod_actions):
+    if mod_actions:
+        candidate = newest_mod_action(mod_actions)
+        newest_id, newest_ts = get_newest_mod_action_idts(cur, feed)
+        if newest_ts and candidate.timestamp < newest_ts:
+            logger.warning("not updating newest mod action as the candidate"
+                           " with id={} and timestamp={} is OLDER than the"
+                           " current one with id={} and timestamp={}".format(
+                           candidate.id, candidate.timestamp,
+                           newest_id, newest_ts))
+            return
+        elif (newest_ts and candidate.timestamp == newest_ts
+              and candidate.id == newest_id):
+            logger.warning("not updating newest mod action with identical"
+                           " id={} and timestamp={}. Bug?".format(
+                           newest_id, newest_ts))
+            return
+        set_meta_value(cur, feed, "newest_modaction_id", candidate.id)
+        set_meta_value(cur, feed, "newest_modaction_timestamp",
+                       candidate.timestamp)
+
+
+def create_modlog_tables(cur):
+    # link_text and link are the text and url of the short link of a mod
+    # action, stored so that reading the rows back needs no parsing of
+    # permalinks. NULL for mod actions without a link, and for those stored
+    # before schema version 11 until `main.py reprocess` fills them in.
+    # "seq" is the row id of the full-text index and of query cursors, an
+    # alias of the rowid that, unlike the implicit one, VACUUM keeps.
+    cur.execute('CREATE TABLE redditmodlog ('
+                '    "seq"          INTEGER PRIMARY KEY,'
+                '    "feed"         TEXT,'
+                '    "id"           TEXT,'
+                '    "timestamp"    INTEGER,'
+                '    "modname"      TEXT,'
+                '    "place"        TEXT,'
+                '    "action"       TEXT,'
+                '    "object"       TEXT,'
+                '    "details"      TEXT,'
+                '    "link_text"    TEXT,'
+                '    "link"         TEXT,'
+                '    UNIQUE ("feed", "id")'
+                ')')
+    # a feed gets its rows here when its first mod actions are stored
+    cur.execute('CREATE TABLE redditmodlog_meta ('
+                '    "feed"         TEXT,'
+                '    "key"          TEXT,'
+                '    "value"        TEXT,'
+                '    PRIMARY KEY ("feed", "key")'
+                ')')
+
+
+def create_modlog_indexes(cur):
+    # for the queries of query.py, all of them list the newest first
+    cur.execute('CREATE INDEX redditmodlog_timestamp'
+                ' ON redditmodlog ("timestamp")')
+    for column in ("modname", "action", "place"):
+        cur.execute('CREATE INDEX redditmodlog_{0}'
+                    ' ON redditmodlog ("{0}", "timestamp")'.format(column))
+
+
+def fts5_available(cur):
+    try:
+        cur.execute("CREATE VIRTUAL TABLE temp.fts5_check USING fts5(x)")
+    except sqlite3.OperationalError:
+        return False
+    cur.execute("DROP TABLE temp.fts5_check")
+    return True
+
+
+def create_modlog_fts(cur):
+    # Full-text index of object and details, kept in sync by triggers. It
+    # stores no copy of the text, only the index. Returns False if this
+    # SQLite build lacks FTS5, searches then fall back to LIKE.
+    if not fts5_available(cur):
+        logger.warning("SQLite has no FTS5, text search will be slow")
+        return False
+    cur.execute("CREATE VIRTUAL TABLE redditmodlog_fts USING fts5("
+                " object, details, content='redditmodlog',"
+                " content_rowid='seq')")
+    cur.execute("CREATE TRIGGER redditmodlog_fts_insert AFTER INSERT"
+                " ON redditmodlog BEGIN"
+                " INSERT INTO redditmodlog_fts(rowid, object, details)"
+                " VALUES (new.seq, new.object, new.details); END")
+    cur.execute("CREATE TRIGGER redditmodlog_fts_delete AFTER DELETE"
+                " ON redditmodlog BEGIN"
+                " INSERT INTO redditmodlog_fts(redditmodlog_fts, rowid,"
+                " object, details)"
+                " VALUES ('delete', old.seq, old.object, old.details); END")
+    cur.execute("CREATE TRIGGER redditmodlog_fts_update AFTER UPDATE"
+                " ON redditmodlog BEGIN"
+                " INSERT INTO redditmodlog_fts(redditmodlog_fts, rowid,"
+                " object, details)"
+                " VALUES ('delete', old.seq, old.object, old.details);"
+                " INSERT INTO redditmodlog_fts(rowid, object, details)"
+                " VALUES (new.seq, new.object, new.details); END")
+    return True
+
+
+def init_db(conn):
+    cur = conn.cursor()
+    create_modlog_tables(cur)
+    create_modlog_indexes(cur)
+    create_modlog_fts(cur)
+    create_outbox_table(cur)
+    create_outbox_index(cur)
+    create_outbox_key_index(cur)
+    create_held_table(cur)
+    cur.execute("PRAGMA user_version = " + str(DB_SCHEMA_VERSION))
+    conn.commit()
+    cur.close()
+    logger.info("initialized database redditmodlog with schema version "
+                + str(DB_SCHEMA_VERSION))
+
+
+# outbox columns of schema versions 7 and 8
+OUTBOX_COLUMNS_V7 = ("seq", "room", "key", "created", "body",
+                     "formatted_body", "status", "attempts", "next_attempt",
+                     "sent")
+
+
+def create_outbox_table(cur):
+    # "key" is the mod action id (or digest key) and makes enqueueing the
+    # same message to the same room twice a no-op, see also
+    # create_outbox_key_index. NULL server means the [matrixconfig]
+    # homeserver, NULL room the default room. "timestamp" is the time of the
+    # (oldest) mod action of a message, for measuring the lag of its
+    # delivery, NULL for messages queued before schema version 10.
+    cur.execute('CREATE TABLE outbox ('
+                '    "seq"            INTEGER PRIMARY KEY AUTOINCREMENT,'
+                '    "server"         TEXT,'
+                '    "room"           TEXT,'
+                '    "key"            TEXT,'
+                '    "created"        INTEGER,'
+                '    "body"           TEXT,'
+                '    "formatted_body" TEXT,'
+                '    "status"         TEXT,'
+                '    "attempts"       INTEGER,'
+                '    "next_attempt"   INTEGER,'
+                '    "sent"           INTEGER,'
+                '    "timestamp"      INTEGER,'
+                '    UNIQUE ("server", "room", "key")'
+                ')')
+
+
+def create_outbox_index(cur):
+    # every destination is drained on its own, oldest message first
+    cur.execute('CREATE INDEX outbox_destination ON outbox'
+                ' ("status", "server", "room", "seq")')
+
+
+def create_outbox_key_index(cur):
+    # the UNIQUE constraint of the table does not cover the default server
+    # and room, as SQLite treats NULLs as distinct from each other
+    cur.execute('CREATE UNIQUE INDEX outbox_key ON outbox'
+                ' (COALESCE("server", \'\'), COALESCE("room", \'\'), "key")')
+
+
+def create_held_table(cur):
+    # new mod actions of the catch-up pages of a check, stored but not yet
+    # queued, so that digests group the whole check. "data" is the mod
+    # action from reddit.dump_mod_action.
+    cur.execute('CREATE TABLE digest_held ('
+                '    "feed"         TEXT,'
+                '    "id"           TEXT,'
+                '    "data"         TEXT,'
+                '    PRIMARY KEY ("feed", "id")'
+                ')')
+
+
+def copy_outbox(cur, columns):
+    # columns of the old outbox, in OUTBOX_COLUMNS_V7 order
+    cur.execute('INSERT INTO outbox_new ({}) SELECT {} FROM outbox'.format(
+                    ", ".join('"{}"'.format(c) for c in OUTBOX_COLUMNS_V7),
+                    columns))
+
+
+def init_raw_db(conn):
+    cur = conn.cursor()
+    create_raw_tables(cur)
+    create_raw_index(cur)
+    insert_raw_dict(cur, compression.default_codec(), False,
+                    compression.SEED_DICT)
+    cur.execute("PRAGMA user_version = " + str(RAW_DB_SCHEMA_VERSION))
+    conn.commit()
+    cur.close()
+    logger.info("initialized database redditmodlog_raw with schema version "
+                + str(RAW_DB_SCHEMA_VERSION))
+
+
+# stay below SQLITE_MAX_VARIABLE_NUMBER of older SQLite builds
+SQL_MAX_VARIABLES = 999
+
+
+def existing_mod_action_ids(cur, feed, mids):
+    mids = list(mids)
+    existing = set()
+    # one slot is taken by the feed
+    step = SQL_MAX_VARIABLES - 1
+    for i in range(0, len(mids), step):
+        chunk = mids[i:i + step]
+        cur.execute('SELECT "id" FROM redditmodlog WHERE "feed"=?'
+                    ' AND "id" IN ({})'.format(",".join("?" * len(chunk))),
+                    [feed] + chunk)
+        existing.update(row[0] for row in cur.fetchall())
+    return existing
+
+
+def mod_action_row(feed, ma):
+    link_text, link = ma.link or (None, None)
+    return (feed, ma.id, ma.timestamp, ma.modname, ma.place, ma.action,
+            ma.object, ma.details, link_text, link)
+
+
+def insert_mod_actions(cur, feed, mas, ignore_existing=False):
+    cur.executemany('INSERT {}INTO redditmodlog ("feed", "id",'
+                    ' "timestamp", "modname", "place", "action", "object",'
+                    ' "details", "link_text", "link")'
+                    ' VALUES (?,?,?,?,?,?,?,?,?,?)'
+                    .format("OR IGNORE " if ignore_existing else ""),
+                    (mod_action_row(feed, ma) for ma in mas))
+
+
+def update_mod_actions(cur, feeds, mas):
+    # updates the stored rows of mas in feeds where a column changed,
+    # returns the number of rows updated. Rows that are equal are not
+    # written, which spares the full-text index too.
+    cur.executemany('UPDATE redditmodlog SET ("timestamp", "modname",'
+                    ' "place", "action", "object", "details", "link_text",'
+                    ' "link") = (?3,?4,?5,?6,?7,?8,?9,?10)'
+                    ' WHERE "feed"=?1 AND "id"=?2'
+                    ' AND ("timestamp", "modname", "place", "action",'
+                    ' "object", "details", "link_text", "link")'
+                    ' IS NOT (?3,?4,?5,?6,?7,?8,?9,?10)',
+                    (mod_action_row(feed, ma) for ma in mas
+                     for feed in feeds))
+    return cur.rowcount
+
+
+def insert_held_mod_actions(cur, feed, data):
+    # data are (id, dumped mod action)
+    cur.executemany('INSERT OR IGNORE INTO digest_held VALUES (?,?,?)',
+                    ((feed, mid, d) for mid, d in data))
+
+
+def take_held_mod_actions(cur, feed):
+    # the dumped mod actions held for feed, which are removed
+    cur.execute('SELECT "data" FROM digest_held WHERE "feed"=?', (feed,))
+    data = [row[0] for row in cur.fetchall()]
+    if data:
+        cur.execute('DELETE FROM digest_held WHERE "feed"=?', (feed,))
+    return data
+
+
+OUTBOX_PENDING = "pending"
+OUTBOX_SENT = "sent"
+OUTBOX_REJECTED = "rejected"
+
+
+OutboxMessage = namedtuple("OutboxMessage", [
+    "seq", "server", "room", "key", "body", "formatted_body", "attempts",
+    "next_attempt", "timestamp"])
+
+
+def insert_outbox_messages(cur, messages):
+    # messages are (server, room, key, body, formatted_body, timestamp)
+    now = int(time.time())
+    cur.executemany('INSERT OR IGNORE INTO outbox ("server", "room", "key",'
+                    ' "created", "body", "formatted_body", "status",'
+                    ' "attempts", "next_attempt", "timestamp")'
+                    ' VALUES (?,?,?,?,?,?,?,0,0,?)',
+        ((server, room, key, now, body, formatted_body, OUTBOX_PENDING, ts)
+         for server, room, key, body, formatted_body, ts in messages))
+
+
+def next_outbox_message(cur, server, room, skip_seqs=()):
+    # the oldest pending message to room on server, skip_seqs are messages
+    # already being sent by another worker
+    cur.execute('SELECT "seq", "server", "room", "key", "body",'
+                ' "formatted_body", "attempts", "next_attempt", "timestamp"'
+                ' FROM outbox WHERE "status"=? AND "server" IS ?'
+                ' AND "room" IS ? AND "seq" NOT IN ({})'
+                ' ORDER BY "seq" LIMIT 1'.format(
+                    ",".join("?" * len(skip_seqs))),
+                (OUTBOX_PENDING, server, room) + tuple(skip_seqs))
+    row = cur.fetchone()
+    return OutboxMessage(*row) if row else None
+
+
+def outbox_destinations(cur):
+    # (server, room) of all pending messages
+    cur.execute('SELECT DISTINCT "server", "room" FROM outbox'
+                ' WHERE "status"=?', (OUTBOX_PENDING,))
+    return cur.fetchall()
+
+
+def mark_outbox_message(cur, seq, status):
+    cur.execute('UPDATE outbox SET "status"=?, "sent"=? WHERE "seq"=?',
+                (status, int(time.time()), seq))
+
+
+def postpone_outbox_message(cur, seq, attempts, next_attempt):
+    cur.execute('UPDATE outbox SET "attempts"=?, "next_attempt"=?'
+                ' WHERE "seq"=?', (attempts, next_attempt, seq))
+
+
+def prune_outbox(cur, before):
+    cur.execute('DELETE FROM outbox WHERE "status"!=? AND "sent"<?',
+                (OUTBOX_PENDING, before))
+
+
+def insert_raw_mod_actions(cur, dict_id, codec, mas):
+    cur.executemany('INSERT OR IGNORE INTO redditmodlog_raw VALUES (?,?,?,?)',
+        ((ma.id, ma.timestamp, dict_id,
+          codec.compress(ma.raw_json.encode("utf-8"))) for ma in mas))
+
+
+def get_raw_dict(cur, dict_id=None):
+    # the given dictionary, or the newest one
+    if dict_id is None:
+        cur.execute('SELECT "id", "codec", "trained", "data"'
+                    ' FROM redditmodlog_raw_dicts ORDER BY "id" DESC LIMIT 1')
+    else:
+        cur.execute('SELECT "id", "codec", "trained", "data"'
+                    ' FROM redditmodlog_raw_dicts WHERE "id"=?', (dict_id,))
+    return cur.fetchone()
+
+
+def get_raw_dicts(cur):
+    # dictionary id -> (codec, data) of all dictionaries
+    cur.execute('SELECT "id", "codec", "data" FROM redditmodlog_raw_dicts')
+    return dict((row[0], (row[1], row[2])) for row in cur.fetchall())
+
+
+def raw_rows_after(cur, after, limit):
+    # (timestamp, id, dict_id, data) of the rows after the (timestamp, id)
+    # of after, oldest first, or of the first rows if after is None. Paging
+    # along the timestamp index takes one short query per page and no sort,
+    # and unlike rowids the keys are kept by VACUUM.
+    if after is None:
+        cur.execute('SELECT "timestamp", "id", "dict_id", "data"'
+                    ' FROM redditmodlog_raw ORDER BY "timestamp", "id"'
+                    ' LIMIT ?', (limit,))
+    else:
+        cur.execute('SELECT "timestamp", "id", "dict_id", "data"'
+                    ' FROM redditmodlog_raw WHERE ("timestamp", "id")>(?,?)'
+                    ' ORDER BY "timestamp", "id" LIMIT ?',
+                    tuple(after) + (limit,))
+    return cur.fetchall()
+
+
+def count_raw_rows(cur, dict_id):
+    return get_db_value(cur, 'SELECT COUNT(*) FROM redditmodlog_raw'
+                        ' WHERE "dict_id"=?', (dict_id,))
+
+
+JOURNAL_MODES = ("delete", "truncate", "persist", "memory", "wal", "off")
+SYNCHRONOUS_MODES = ("off", "normal", "full", "extra")
+
+
+def connect(db_file, journal_mode, synchronous):
+    if journal_mode not in JOURNAL_MODES:
+        raise Exception("unexpected journal mode: " + journal_mode)
+    if synchronous not in SYNCHRONOUS_MODES:
+        raise Exception("unexpected synchronous mode: " + synchronous)
+    conn = sqlite3.connect(db_file)
+    # journal_mode=wal is persistent in the db file, synchronous is not
+    conn.execute("PRAGMA journal_mode = " + journal_mode)
+    conn.execute("PRAGMA synchronous = " + synchronous)
+    return conn
+
+
+# Long-lived connections to the modlog db and the optional raw db. Schemas
+# are checked once on open, and keeping the connections open lets sqlite3
+# reuse its cache of prepared statements across poll cycles.
+class Storage:
+    def __init__(self, db_file, raw_db_file=None, journal_mode="wal",
+                 synchronous="normal"):
+        self.conn = connect(db_file, journal_mode, synchronous)
+        self.cur = self.conn.cursor()
+        if not db_initialized(self.cur):
+            init_db(self.conn)
+        # feeds that have completed a check before, see first_run
+        self.known_feeds = get_meta_feeds(self.cur)
+
+        self.raw = (RawArchive(raw_db_file, journal_mode, synchronous)
+                    if raw_db_file else None)
+
+    @property
+    def saves_raw(self):
+        return self.raw is not None
+
+    def first_run(self, feed):
+        # True until the first check of the feed is stored, even one that
+        # found no mod actions
+        return feed not in self.known_feeds
+
+    def newest_mod_action_idts(self, feed):
+        return get_newest_mod_action_idts(self.cur, feed)
+
+    def existing_mod_action_ids(self, feed, mids):
+        return existing_mod_action_ids(self.cur, feed, mids)
+
+    # The writes below skip empty lists: sqlite3 begins a transaction even
+    # for an empty executemany.
+
+    def insert_mod_actions(self, feed, mas, ignore_existing=False):
+        if mas:
+            insert_mod_actions(self.cur, feed, mas, ignore_existing)
+
+    def update_newest_mod_action(self, feed, mod_actions):
+        if feed not in self.known_feeds:
+            set_meta_value(self.cur, feed, "newest_modaction_id", "")
+            set_meta_value(self.cur, feed, "newest_modaction_timestamp", "")
+            self.known_feeds.add(feed)
+        update_newest_mod_action(self.cur, feed, mod_actions)
+
+    def http_validators(self, feed, url):
+        return get_http_validators(self.cur, feed, url)
+
+    def set_http_validators(self, feed, url, etag, last_modified):
+        set_http_validators(self.cur, feed, url, etag, last_modified)
+
+    def backfill_cursor(self, feed):
+        # the listing cursor of the next page to backfill, None to start from
+        # the newest page
+        return get_meta_value(self.cur, feed, "backfill_after", str) or None
+
+    def set_backfill_cursor(self, feed, after):
+        set_meta_value(self.cur, feed, "backfill_after", after or "")
+
+    def update_mod_actions(self, feeds, mas):
+        if not mas:
+            return 0
+        return update_mod_actions(self.cur, feeds, mas)
+
+    def reprocess_checkpoint(self):
+        # (timestamp, id) of the last raw row reprocessed, None to start from
+        # the first
+        ts = get_meta_value(self.cur, REPROCESS_META_FEED,
+                            "reprocess_after_timestamp", int_or_none)
+        if ts is None:
+            return None
+        return ts, get_meta_value(self.cur, REPROCESS_META_FEED,
+                                  "reprocess_after_id", str)
+
+    def set_reprocess_checkpoint(self, after):
+        ts, mid = after or ("", "")
+        set_meta_value(self.cur, REPROCESS_META_FEED,
+                       "reprocess_after_timestamp", ts)
+        set_meta_value(self.cur, REPROCESS_META_FEED, "reprocess_after_id",
+                       mid)
+
+    def hold_mod_actions(self, feed, data):
+        if data:
+            insert_held_mod_actions(self.cur, feed, data)
+
+    def take_held_mod_actions(self, feed):
+        return take_held_mod_actions(self.cur, feed)
+
+    def add_to_outbox(self, messages):
+        if messages:
+            insert_outbox_messages(self.cur, messages)
+
+    @contextmanager
+    def transaction(self):
+        # The write lock is taken up front. A deferred transaction that reads
+        # before its first write fails at once with "database is locked" when
+        # another connection, like the sender's, commits in between, without
+        # waiting for the busy timeout.
+        known_feeds = set(self.known_feeds)
+        if not self.conn.in_transaction:
+            self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            self.known_feeds = known_feeds
+            raise
+
+    def save_raw(self, mod_actions):
+        if self.raw:
+            self.raw.save(mod_actions)
+
+    def close(self):
+        self.conn.close()
+        if self.raw:
+            self.raw.close()
+
+
+# The raw db keeps the unmodified Reddit object of every mod action, each
+# compressed on its own with a dictionary shared by many rows, see
+# compression.py. New archives start with a generic dictionary and switch to
+# one trained on their own rows once there are enough of them.
+class RawArchive:
+    def __init__(self, db_file, journal_mode="wal", synchronous="normal"):
+        self.conn = connect(db_file, journal_mode, synchronous)
+        self.cur = self.conn.cursor()
+        if not raw_db_initialized(self.cur):
+            init_raw_db(self.conn)
+        self.use_dict(get_raw_dict(self.cur))
+        self.codecs = {}
+
+    def use_dict(self, row):
+        self.dict_id, codec, self.trained, dictionary = row
+        self.codec = compression.Codec(codec, dictionary)
+        self.untrained_rows = (0 if self.trained
+                               else count_raw_rows(self.cur, self.dict_id))
+
+    def save(self, mod_actions):
+        if not mod_actions:
+            return
+        insert_raw_mod_actions(self.cur, self.dict_id, self.codec,
+                               mod_actions)
+        self.conn.commit()
+        if not self.trained:
+            self.untrained_rows += len(mod_actions)
+            if self.untrained_rows >= RAW_TRAIN_SAMPLES:
+                self.train()
+
+    def train(self):
+        self.cur.execute('SELECT "data" FROM redditmodlog_raw'
+                         ' WHERE "dict_id"=? ORDER BY "timestamp" DESC'
+                         ' LIMIT ?', (self.dict_id, RAW_TRAIN_SAMPLES))
+        samples = [self.codec.decompress(row[0])
+                   for row in self.cur.fetchall()][::-1]
+        codec = compression.default_codec()
+        dict_id = insert_raw_dict(
+            self.cur, codec, True,
+            compression.train_dictionary(codec, samples))
+        self.conn.commit()
+        # rows stored so far keep the dictionary they were compressed with
+        self.use_dict(get_raw_dict(self.cur, dict_id))
+        logger.info("trained raw data compression dictionary {}".format(
+                        dict_id))
+
+    def decompressor(self, dict_id):
+        codec = self.codecs.get(dict_id)
+        if codec is None:
+            _, name, _, dictionary = get_raw_dict(self.cur, dict_id)
+            codec = compression.Codec(name, dictionary)
+            self.codecs[dict_id] = codec
+        return codec
+
+    def iter_rows(self, since=None):
+        # (id, timestamp, raw JSON) oldest first, read in batches
+        cur = self.conn.cursor()
+        cur.execute('SELECT "id", "timestamp", "dict_id", "data"'
+                    ' FROM redditmodlog_raw WHERE "timestamp">=?'
+                    ' ORDER BY "timestamp", "id"',
+                    (since or 0,))
+        try:
+            while True:
+                rows = cur.fetchmany(RAW_BATCH_SIZE)
+                if not rows:
+                    break
+                for mid, ts, dict_id, data in rows:
+                    raw_json = self.decompressor(dict_id).decompress(data)
+                    yield mid, ts, raw_json.decode("utf-8")
+        finally:
+            cur.close()
+
+    def dictionaries(self):
+        return get_raw_dicts(self.cur)
+
+    def rows_after(self, after, limit=RAW_BATCH_SIZE):
+        return raw_rows_after(self.cur, after, limit)
+
+    def export_jsonl(self, out, since=None):
+        count = 0
+        for _, _, raw_json in self.iter_rows(since):
+            out.write(raw_json)
+            out.write("\n")
+            count += 1
+        return count
+
+    def close(self):
+        self.conn.close()
+
+
+# Outbox access for the sender thread, which needs its own connection
+class Outbox:
+    def __init__(self, db_file, journal_mode="wal", synchronous="normal"):
+        self.conn = connect(db_file, journal_mode, synchronous)
+        self.cur = self.conn.cursor()
+
+    def next_message(self, server, room, skip_seqs=()):
+        return next_outbox_message(self.cur, server, room, skip_seqs)
+
+    def destinations(self):
+        return outbox_destinations(self.cur)
+
+    def mark_sent(self, seq):
+        mark_outbox_message(self.cur, seq, OUTBOX_SENT)
+        self.conn.commit()
+
+    def mark_rejected(self, seq):
+        mark_outbox_message(self.cur, seq, OUTBOX_REJECTED)
+        self.conn.commit()
+
+    def postpone(self, seq, attempts, next_attempt):
+        postpone_outbox_message(self.cur, seq, attempts, next_attempt)
+        self.conn.commit()
+
+    def prune(self, before):
+        prune_outbox(self.cur, before)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def journal_settings(config):
+    cfg = config["redditmodlog"]
+    return (cfg.get("db_journal_mode", fallback="wal").lower(),
+            cfg.get("db_synchronous", fallback="normal").lower())
+
+
+def outbox_from_config(config):
+    return Outbox(config["redditmodlog"]["dbfile"], *journal_settings(config))
+
+
+def migrate_from_config(config, dry_run=False):
+    # upgrades both databases, if they exist, without opening them for use.
+    # Returns (database, step reports) pairs.
+    cfg = config["redditmodlog"]
+    results = []
+    for name, db_file, table, upgrade in (
+            ("redditmodlog", cfg["dbfile"], "redditmodlog", upgrade_db),
+            ("redditmodlog_raw", cfg["json_raw_dbfile"], "redditmodlog_raw",
+             upgrade_raw_db)):
+        if not os.path.exists(db_file):
+            continue
+        # journal_mode=wal persists in the file, so a dry run, which must
+        # leave the file as it was, does not set it
+        conn = (sqlite3.connect(db_file) if dry_run
+                else connect(db_file, *journal_settings(config)))
+        try:
+            cur = conn.cursor()
+            if table_exists(cur, table):
+                results.append((name, upgrade(cur, dry_run)))
+        finally:
+            conn.close()
+    return results
+
+
+def raw_archive_from_config(config):
+    return RawArchive(config["redditmodlog"]["json_raw_dbfile"],
+                      *journal_settings(config))
+
+
+def from_config(config, feeds):
+    cfg = config["redditmodlog"]
+    save_raw = (conf.enabled(cfg["json_save_raw"])
+                and any(feed.mode == "json" for feed in feeds))
+    return Storage(cfg["dbfile"],
+                   cfg["json_raw_dbfile"] if save_raw else None,
+                   *journal_settings(config))
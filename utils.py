@@ -1,28 +1,34 @@
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from itertools import islice
 import json
-import time
-from urllib.parse import urlparse
-
-from log import logger
 
 
 def json_compact(obj):
     return json.dumps(obj, separators=(",", ":"), sort_keys=True)
 
 
-def request_retrying(fn, url, retries=0, wait_sec=1):
-    retry = 0
-    host = urlparse(url).hostname
-    while retry <= retries:
-        resp = fn(url)
-        if resp.status_code == 200:
-            return resp
-        else:
-            retry += 1
-            retrying = (", retrying in {} s".format(wait_sec)
-                        if retry <= retries else "")
-            logger.warning("{}: response status {}{}".format(
-                host, str(resp.status_code), retrying))
-            time.sleep(wait_sec)
-    logger.warning("{}: failed to fetch with {} retries, giving up this"
-                   " request".format(host, retries))
-    return None
+def chunks(iterable, size):
+    # lists of up to size items, consuming iterable lazily
+    it = iter(iterable)
+    chunk = list(islice(it, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(it, size))
+
+
+def parse_retry_after(value):
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0, (when - datetime.now(timezone.utc)).total_seconds())